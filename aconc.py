@@ -0,0 +1,216 @@
+import asyncio
+import random
+import selectors
+from collections import deque
+from typing import Hashable
+
+"""
+asyncio counterparts of the primitives in conc. Everything here must be
+used from coroutines running on a single event loop; waiting suspends
+the coroutine instead of blocking a thread.
+"""
+
+"""
+Lightswitch class from classical problems chapter
+"""
+class Lightswitch:
+    def __init__(self):
+        self.counter = 0
+        self.mutex = asyncio.Lock()
+
+    async def lock(self, semaphore: asyncio.Semaphore):
+        async with self.mutex:
+            self.counter += 1
+            if self.counter == 1:
+                try:
+                    await semaphore.acquire()
+                except BaseException:
+                    # cancelled: the next lock() must acquire it again
+                    self.counter -= 1
+                    raise
+
+    async def unlock(self, semaphore: asyncio.Semaphore):
+        async with self.mutex:
+            self.counter -= 1
+            if self.counter == 0:
+                semaphore.release()
+
+"""
+Similar to the Lightswitch class from the classical problems chapter,
+but makes explicit the relationship between gatekeeper and gate visitors.
+"""
+class Gate:
+    def __init__(self):
+        self._count = 0
+        self._mutex = asyncio.Lock()
+        self._control = asyncio.Lock()
+        self._turnstile = asyncio.Lock()
+
+    async def enter(self):
+        async with self._turnstile:
+            pass
+        async with self._mutex:
+            if self._count == 0:
+                await self._control.acquire()
+            self._count += 1
+
+    async def exit(self):
+        async with self._mutex:
+            self._count -= 1
+            if self._count < 0:
+                raise RuntimeError("exit called more times than allowed")
+            if self._count == 0:
+                self._control.release()
+
+    """
+    Prevents entry until open()'d, and blocks the calling task
+    until all entered tasks have exited.
+    """
+    async def close(self):
+        await self._turnstile.acquire()
+        try:
+            await self._control.acquire()
+        except BaseException:
+            self._turnstile.release()
+            raise
+
+    def open(self):
+        self._control.release()
+        self._turnstile.release()
+
+
+"""
+Pairs each syncA caller with a syncB caller and swaps their values.
+Whoever arrives second completes the exchange directly into the
+waiting peer's future, so each exchange is a single wakeup.
+"""
+class Synchronizer:
+    def __init__(self):
+        self.aq = deque()
+        self.bq = deque()
+
+    async def _sync(self, send, mine: deque, theirs: deque):
+        while theirs:
+            peer, value = theirs.popleft()
+            if not peer.done():
+                peer.set_result(send)
+                return value
+        peer = asyncio.get_running_loop().create_future()
+        mine.append((peer, send))
+        return await peer
+
+    async def syncA(self, send=None):
+        return await self._sync(send, self.aq, self.bq)
+
+    async def syncB(self, send=None):
+        return await self._sync(send, self.bq, self.aq)
+
+
+_lockLookup = {}
+
+# async with lock(key) behaves like conc.lock. Entries are reference
+# counted and dropped once no task holds or waits on them; no registry
+# mutex is needed since lookups never yield to the event loop.
+class lock:
+    def __init__(self, key: Hashable):
+        self.key = key
+
+    async def __aenter__(self):
+        entry = _lockLookup.get(self.key)
+        if entry is None:
+            entry = _lockLookup[self.key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            await entry[0].acquire()
+        except BaseException:
+            self._drop(entry)
+            raise
+
+    async def __aexit__(self, type, val, traceback):
+        entry = _lockLookup[self.key]
+        entry[0].release()
+        self._drop(entry)
+
+    def _drop(self, entry):
+        entry[1] -= 1
+        if entry[1] == 0:
+            del _lockLookup[self.key]
+
+def semaphores(*sizes):
+    return (asyncio.Semaphore(s) for s in sizes)
+
+
+"""
+Event loop whose clock only moves when every task is blocked: instead of
+waiting for the next timer it jumps straight to it. Sleeps cost no wall
+time, and since everything runs on one thread in a fixed order, runs are
+reproducible.
+
+The jump happens in the loop's selector, which is handed the time until
+the next timer as its timeout and, rather than waiting that long, adds
+it to the virtual clock. A select with no timeout means no timer is left
+to wake anything, i.e. the simulation has deadlocked.
+"""
+class _VirtualClockSelector(selectors.DefaultSelector):
+    def __init__(self):
+        super().__init__()
+        self.now = 0.0
+
+    def select(self, timeout=None):
+        if timeout is None:
+            raise RuntimeError(f"simulation deadlocked at t={self.now}: every task is blocked")
+        self.now += max(timeout, 0)
+        return super().select(0)
+
+class VirtualTimeLoop(asyncio.SelectorEventLoop):
+    def __init__(self):
+        self._clock = _VirtualClockSelector()
+        super().__init__(self._clock)
+
+    def time(self):
+        return self._clock.now
+
+"""
+Deterministic discrete-event run of coroutine actors. Actors should pace
+themselves with sim.sleep and draw randomness from sim.random, which is
+seeded, so the same seed gives the same run.
+
+    sim = Simulation(seed=1)
+    stats = sim.run(p7_4_sim(sim, capacity=10), until=3600)
+"""
+class Simulation:
+    def __init__(self, seed=None):
+        self.random = random.Random(seed)
+        self.loop = VirtualTimeLoop()
+
+    def now(self) -> float:
+        return self.loop.time()
+
+    async def sleep(self, delay: float):
+        await asyncio.sleep(delay)
+
+    def spawn(self, coro) -> asyncio.Task:
+        return self.loop.create_task(coro)
+
+    # Runs main and everything it spawns, until every task has finished or,
+    # if until is given, the virtual clock reaches it. Tasks still running
+    # are then cancelled. Returns main's result, or None if main itself
+    # was still running at until.
+    def run(self, main, until: float = None):
+        asyncio.set_event_loop(self.loop)
+        try:
+            task = self.spawn(main)
+            if until is None:
+                while pending := asyncio.all_tasks(self.loop):
+                    self.loop.run_until_complete(asyncio.wait(pending))
+            else:
+                self.loop.run_until_complete(asyncio.sleep(until - self.now()))
+                if not task.done():
+                    return None
+            return task.result()
+        finally:
+            for t in (pending := asyncio.all_tasks(self.loop)):
+                t.cancel()
+            self.loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+            asyncio.set_event_loop(None)
+            self.loop.close()
@@ -1,13 +1,13 @@
+import asyncio
 import random
 from collections import deque
-from threading import Semaphore as Sem
-from time import sleep
 from functools import reduce
 
-from conc import thread, Synchronizer, lock, semaphores, Gate
+from conc import thread, Synchronizer, lock, semaphores, trace, rounds, sleep, Semaphore as Sem, select_acquire, FifoSemaphore, SIDList, SeqLock
+import aconc
 
-def out(label, msg, *a, **kw):
-    print(f"{label}: {msg}", *a, **kw, flush=True)
+def out(label, msg):
+    trace.event(label, msg)
 
 """
 6.1 The search-insert-delete problem
@@ -15,92 +15,85 @@ def out(label, msg, *a, **kw):
 Given a singly linked list, we have threads consisting of searchers, inserters
 and deleters. Searchers examine the list and can execute concurrently.
 Inserters add to the end of the list in a mutex fashion, but any insert
-can be concurrent with searches.
+can be concurrent with searches. Deleters used to close a Gate around the
+whole list; conc.SIDList only has them lock the nodes around the one they
+remove, so searches, inserts and deletes elsewhere in the list carry on.
 """
-def p6_1():
-    n_search = 7
-    n_insert = 3
-    n_delete = 2
+def p6_1(n_search=7, n_insert=3, n_delete=2, n_rounds=None, size=20):
 
-    gate = Gate()
+    items = SIDList(range(size))
+    next_item = size
 
     @thread()
     def searcher(lbl: str):
-        while True:
+        for _ in rounds(n_rounds):
             sleep(random.random() * 0.3)
-            gate.enter()
-            out(lbl, "search")
-            gate.exit()
+            item = random.randrange(next_item)
+            found = items.search(item)
+            out(lbl, f"search {item}: {'found' if found else 'missing'}")
         
     @thread()
     def inserter(lbl: str):
-        while True:
+        nonlocal next_item
+        for _ in rounds(n_rounds):
             sleep(random.random() * 0.5)
-            gate.enter()
-            out(lbl, "insert")
-            gate.exit()
+            with lock("next_item"):
+                item = next_item
+                next_item += 1
+            items.insert(item)
+            out(lbl, f"insert {item}")
 
     @thread()
     def deleter(lbl: str):
-        while True:
+        for _ in rounds(n_rounds):
             sleep(3 + random.random() * 2)
-            out(lbl, "locking for deletion")
-            gate.close()
-            out(lbl, "deleting...")
-            sleep(1)
-            out(lbl, "deleted.")
-            gate.open()
-
-    for i in range(n_search):
-        searcher(f"[srch {i}]").start()
-    for i in range(n_insert):
-        inserter(f"[inst {i}]").start()
-    for i in range(n_delete):
-        deleter(f"[dlte {i}]").start()
+            item = random.randrange(next_item)
+            deleted = items.delete(item)
+            out(lbl, f"delete {item}: {'deleted' if deleted else 'missing'}")
+
+    return ([searcher(f"[srch {i}]").start() for i in range(n_search)]
+            + [inserter(f"[inst {i}]").start() for i in range(n_insert)]
+            + [deleter(f"[dlte {i}]").start() for i in range(n_delete)])
 
 """
 7.3 The room party problem
 """
 
-def p7_3():
-    party = 50 # number of people constituting a party
-    n = 200 # number of students
-    rooms = [0] * 5
+def p7_3(party=50, n=200, n_rooms=5, n_rounds=None):
+    # party: number of people constituting a party
+    # n: number of students
+    # lock(i) still orders decisions about room i; rooms itself is a
+    # SeqLock so the dean can print all of it without taking any lock
+    rooms = SeqLock([0] * n_rooms)
     parties = list(semaphores(*[1 for _ in range(len(rooms))]))
 
     def state():
-        r = []
-        for i in range(len(rooms)):
-            with lock(i):
-                r.append(rooms[i])
-        return " ".join(f"[{i}]" for i in r)
+        return " ".join(f"[{i}]" for i in rooms.read())
 
     @thread()
     def student(lbl: str):
         in_room = None
-        while True:
+        for _ in rounds(n_rounds):
             sleep(random.random() * 0.2)
             if in_room is not None: 
-                with lock(in_room):
-                    population = rooms[in_room]
+                population = rooms[in_room]
                 # linger in rooms with more people
                 sleep(random.random() * (population)**2 / party)
-                with lock(in_room):
-                    rooms[in_room] -= 1
+                with lock(in_room), rooms.write() as r:
+                    r[in_room] -= 1
                     in_room = None
             else:
-                # look for a room that's not locked by dean
-                while not parties[target := random.randint(0, len(rooms)-1)].acquire(blocking=False):
-                    pass
-                with lock(target):
+                # sleep until some room isn't locked by dean
+                target = select_acquire(parties)
+                with lock(target), rooms.write() as r:
                     parties[target].release()
                     in_room = target
-                    rooms[target] += 1
+                    r[target] += 1
     
     @thread()
     def dean(lbl: str):
         waiting = None
-        while True:
+        for _ in rounds(n_rounds):
             sleep(0.5)
             out(lbl, f"start: {state()}")
             if waiting is not None:
@@ -123,11 +116,12 @@ def p7_3():
                         waiting = target
                         parties[target].acquire()
             out(lbl, f"end: {state()}")
+        # let students back into a room the dean was still clearing
+        if waiting is not None:
+            parties[waiting].release()
             
-    for i in range(n):
-        student(f"[student {i}]").start()
-    
-    dean("[dean]").start()
+    students = [student(f"[student {i}]").start() for i in range(n)]
+    return students + [dean("[dean]").start()]
     
 """
 7.4 The Senate Bus Problem
@@ -148,18 +142,17 @@ final list of riders going to the next stop.
 No global data is shared between threads other than the synchronization objects.
 """
 
-def p7_4():
-    n = 20
-    busses = 2
-    capacity = 5
-    stops = [0] * 6
+def p7_4(n=20, busses=2, capacity=5, n_stops=6, n_rounds=None):
+    stops = [0] * n_stops
+    # boardings still to come before the busses can stop running
+    trips_left = None if n_rounds is None else n * n_rounds
     turnstile = [Sem(0) for _ in range(len(stops))]
-    boarding = [(Synchronizer(), Sem(0)) for _ in range(len(stops))]
+    boarding = [(Synchronizer(), FifoSemaphore(0)) for _ in range(len(stops))]
 
     @thread()
     def passenger(lbl: str):
         stop = random.randrange(len(stops))
-        while(True):
+        for _ in rounds(n_rounds):
             sleep(1 + random.random() * 2)
             out(lbl, f"arrived at {stop}")
             with lock(stop):
@@ -174,8 +167,8 @@ def p7_4():
     @thread()
     def bus(lbl: str):
         stop = random.randrange(len(stops))
-        passengers = []
-        while True:
+        nonlocal trips_left
+        while trips_left is None or trips_left > 0:
             sleep(1 + random.random())
             
             with lock(stop):
@@ -186,20 +179,70 @@ def p7_4():
                     stops[stop] -= to_board
                     turnstile[stop].release(to_board)
                     # wait for all passengers to get on
-                    for _ in range(to_board):
-                        passengers.append(boarding[stop][0].syncB(lbl))
-                    for _ in range(to_board):
-                        boarding[stop][1].acquire()
+                    passengers = boarding[stop][0].gather(to_board, lbl)
+                    boarding[stop][1].acquire(n=to_board)
+                    if trips_left is not None:
+                        with lock("trips_left"):
+                            trips_left -= to_board
                     out(lbl, f"leaving {stop} with {len(passengers)} passengers: {' '.join(passengers)}")
                 else:
                     out(lbl, f"leaving {stop} with no passengers")
             stop = (stop + 1) % len(stops)
-            passengers = []
 
-    for i in range(busses):
-        bus(f"[bus {i}]").start()
-    
-    for i in range(n):
-        passenger(f"[pass {i}]").start()
+    return ([bus(f"[bus {i}]").start() for i in range(busses)]
+            + [passenger(f"[pass {i}]").start() for i in range(n)])
 
 
+"""
+7.4 on the virtual clock
+
+The same bus route written against aconc, paced by sim.sleep and sim.random
+so it can run under aconc.Simulation: an hour of simulated service takes
+milliseconds, and a given seed always gives the same run. Returns a dict of
+counters that fills in as the simulation runs, e.g. to sweep capacity:
+
+    for capacity in range(1, 20):
+        sim = Simulation(seed=0)
+        print(capacity, sim.run(p7_4_sim(sim, capacity=capacity), until=3600))
+"""
+
+async def p7_4_sim(sim, n=20, busses=2, capacity=5, n_stops=6):
+    stops = [0] * n_stops
+    turnstile = [asyncio.Semaphore(0) for _ in range(n_stops)]
+    boarding = [(aconc.Synchronizer(), asyncio.Semaphore(0)) for _ in range(n_stops)]
+    stats = {"boarded": 0, "departures": 0, "max_waiting": 0}
+
+    async def passenger(lbl: str):
+        stop = sim.random.randrange(n_stops)
+        while True:
+            await sim.sleep(1 + sim.random.random() * 2)
+            async with aconc.lock(("stop", stop)):
+                stops[stop] += 1
+                stats["max_waiting"] = max(stats["max_waiting"], stops[stop])
+            await turnstile[stop].acquire()
+            await boarding[stop][0].syncA(lbl)
+            boarding[stop][1].release()
+            stop = sim.random.randrange(n_stops)
+
+    async def bus(lbl: str):
+        stop = sim.random.randrange(n_stops)
+        while True:
+            await sim.sleep(1 + sim.random.random())
+            async with aconc.lock(("stop", stop)):
+                to_board = min(stops[stop], capacity)
+                stops[stop] -= to_board
+                for _ in range(to_board):
+                    turnstile[stop].release()
+                for _ in range(to_board):
+                    await boarding[stop][0].syncB(lbl)
+                for _ in range(to_board):
+                    await boarding[stop][1].acquire()
+                stats["boarded"] += to_board
+                stats["departures"] += 1
+            stop = (stop + 1) % n_stops
+
+    for i in range(busses):
+        sim.spawn(bus(f"[bus {i}]"))
+    for i in range(n):
+        sim.spawn(passenger(f"[pass {i}]"))
+    return stats
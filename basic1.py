@@ -1,5 +1,5 @@
 from threading import Semaphore as Sem
-from conc import thread
+from conc import thread, Barrier
 
 """
 3.3 Rendezvous
@@ -30,6 +30,7 @@ def p3_3():
 
     aThread = a().start()
     bThread = b().start()
+    return [aThread, bThread]
 
 """
 3.6 Barrier
@@ -37,71 +38,33 @@ def p3_3():
 Ensure no thread goes into phase 2 until all have.
 """
 
-def p3_6():
-    n_instances = 20
-    n_waiting = 0
-    access = Sem(1)
-    barrier = Sem(0)
+def p3_6(n_instances=20):
+    barrier = Barrier(n_instances)
 
     @thread()
     def instance(v: int):
         print(f"inst {v} phase 1")
-        access.acquire()
-        nonlocal n_waiting
-        n_waiting = n_waiting + 1
-        access.release()
-        if (n_waiting < n_instances):
-            barrier.acquire()
-            barrier.release()
-        else:
-            barrier.release()
+        barrier.wait()
         print(f"inst {v} phase 2")
 
-    for i in range(n_instances):
-        instance(i).start()
+    return [instance(i).start() for i in range(n_instances)]
 
 """
 3.7 Reusable Barrier
 
-Same as above, but perform an arbitrary number of phases
+Same as above, but perform an arbitrary number of phases.
+The hand-rolled version needed a two-phase turnstile (like a river
+lock, the nth thread closes the back gate before opening the front)
+so fast threads couldn't lap slow ones; Barrier's generation counter
+gives the same guarantee with a single gate.
 """
-def p3_7():
-    n_instances = 6
-    n_waiting = 0
-    n_phases = 5
-    access = Sem(1)
-    phase_start = Sem(0)
-    phase_end = Sem(1)
+def p3_7(n_instances=6, n_phases=5):
+    barrier = Barrier(n_instances)
 
     @thread()
     def instance(v: int):
-        nonlocal n_waiting
         for i in range(n_phases):
-            # two-phase barrier, aka turnstile.
-            # works like a river lock: the nth thread
-            # locks the back barrier before opening the front.
             print(f"inst {v} phase {i+1}")
-            access.acquire()
-            n_waiting += 1
-            if n_waiting == n_instances:
-                n_waiting = 0
-                phase_end.acquire()
-                phase_start.release()
-            access.release()
-
-            phase_start.acquire()
-            phase_start.release()
-
-            access.acquire()
-            n_waiting += 1
-            if n_waiting == n_instances:
-                n_waiting = 0
-                phase_start.acquire()
-                phase_end.release()
-            access.release()
-
-            phase_end.acquire()
-            phase_end.release()
-
-    for i in range(n_instances):
-        instance(i).start()
+            barrier.wait()
+
+    return [instance(i).start() for i in range(n_instances)]
@@ -0,0 +1,712 @@
+import sys
+import random
+import tracemalloc
+from contextlib import contextmanager
+from threading import Semaphore as Sem
+from collections import deque
+from time import perf_counter, process_time, sleep
+
+from conc import thread, Synchronizer, Barrier, RWLock, BoundedQueue, process_stage, Semaphore, select_acquire, BatchBarrier, FifoSemaphore, Gate, SIDList, map_parallel, PrioritySemaphore, SeqLock, RCUCell
+from bonus5 import Cascade, SparseCascade, CascadePipeline
+
+"""
+Microbenchmarks for the conc primitives.
+
+Run with `python bench.py [name ...]`; with no names every benchmark runs.
+"""
+
+def report(title: str, rows: list[tuple]):
+    print(title)
+    for row in rows:
+        cells = (f"{c:,.0f}" if isinstance(c, float) else str(c) for c in row)
+        print("  " + "".join(f"{c:>24}" for c in cells))
+
+def timed(actors: list) -> float:
+    start = perf_counter()
+    for t in [a.start() for a in actors]:
+        t.join()
+    return perf_counter() - start
+
+
+"""
+The five-semaphore Synchronizer conc shipped before the slot-based
+rendezvous, kept here as the baseline for bench_synchronizer.
+"""
+class SemaphoreSynchronizer:
+    def __init__(self):
+        self.mutex = Sem(1)
+        self.mutA = Sem(0)
+        self.mutB = Sem(0)
+        self.mutASend = Sem(0)
+        self.mutBSend = Sem(0)
+        self.aq = deque()
+        self.bq = deque()
+
+    def syncA(self, send=None):
+        self.mutB.release()
+        self.mutA.acquire()
+        self.mutex.acquire()
+        self.aq.append(send)
+        self.mutex.release()
+        self.mutBSend.release()
+        self.mutASend.acquire()
+        self.mutex.acquire()
+        v = self.bq.popleft()
+        self.mutex.release()
+        return v
+
+    def syncB(self, send=None):
+        self.mutA.release()
+        self.mutB.acquire()
+        self.mutex.acquire()
+        self.bq.append(send)
+        self.mutex.release()
+        self.mutASend.release()
+        self.mutBSend.acquire()
+        self.mutex.acquire()
+        v = self.aq.popleft()
+        self.mutex.release()
+        return v
+
+def bench_synchronizer(exchanges: int = 20000):
+    rows = [("threads", "impl", "exchanges/s")]
+    for n_threads in (2, 8, 64):
+        per_pair = exchanges // (n_threads // 2)
+        for impl in (SemaphoreSynchronizer, Synchronizer):
+            sync = impl()
+
+            @thread()
+            def a():
+                for i in range(per_pair):
+                    sync.syncA(i)
+
+            @thread()
+            def b():
+                for i in range(per_pair):
+                    sync.syncB(i)
+
+            pairs = n_threads // 2
+            elapsed = timed([a() for _ in range(pairs)] + [b() for _ in range(pairs)])
+            rows.append((n_threads, impl.__name__, per_pair * pairs / elapsed))
+    report("Synchronizer rendezvous", rows)
+
+
+"""
+The counter-and-two-turnstiles barrier basic1.p3_7 used before Barrier,
+kept as the baseline for bench_barrier.
+"""
+class TurnstileBarrier:
+    def __init__(self, n: int):
+        self.n = n
+        self.waiting = 0
+        self.access = Sem(1)
+        self.phase_start = Sem(0)
+        self.phase_end = Sem(1)
+
+    def wait(self):
+        self.access.acquire()
+        self.waiting += 1
+        if self.waiting == self.n:
+            self.waiting = 0
+            self.phase_end.acquire()
+            self.phase_start.release()
+        self.access.release()
+        self.phase_start.acquire()
+        self.phase_start.release()
+
+        self.access.acquire()
+        self.waiting += 1
+        if self.waiting == self.n:
+            self.waiting = 0
+            self.phase_start.acquire()
+            self.phase_end.release()
+        self.access.release()
+        self.phase_end.acquire()
+        self.phase_end.release()
+
+def bench_barrier(crossings: int = 20000):
+    rows = [("threads", "impl", "phases/s")]
+    for n_threads in (6, 64, 512):
+        phases = max(crossings // n_threads, 10)
+        for impl in (TurnstileBarrier, Barrier):
+            barrier = impl(n_threads)
+
+            @thread()
+            def instance():
+                for _ in range(phases):
+                    barrier.wait()
+
+            elapsed = timed([instance() for _ in range(n_threads)])
+            rows.append((n_threads, impl.__name__, phases / elapsed))
+    report("Barrier phases", rows)
+
+
+"""
+classic2.p4_3's no-starve scheme: every read and write runs inside the
+two-phase turnstile, guarded by read_lock/write_lock as in p4_2.
+"""
+class TurnstileRWLock:
+    def __init__(self):
+        self.write_lock = Sem(1)
+        self.read_lock = Sem(1)
+        self.reading = 0
+        self.wait_lock = Sem(1)
+        self.w1_lock = Sem(1)
+        self.w2_lock = Sem(0)
+        self.w1 = 0
+        self.w2 = 0
+
+    @contextmanager
+    def _turnstile(self):
+        self.wait_lock.acquire()
+        self.w1 += 1
+        self.wait_lock.release()
+
+        self.w1_lock.acquire()
+        self.w2 += 1
+        self.wait_lock.acquire()
+        self.w1 -= 1
+        if self.w1 == 0:
+            self.wait_lock.release()
+            self.w2_lock.release()
+        else:
+            self.wait_lock.release()
+            self.w1_lock.release()
+
+        self.w2_lock.acquire()
+        self.w2 -= 1
+        yield
+        if self.w2 == 0:
+            self.w1_lock.release()
+        else:
+            self.w2_lock.release()
+
+    @contextmanager
+    def read(self):
+        with self._turnstile():
+            self.read_lock.acquire()
+            if self.reading == 0:
+                self.write_lock.acquire()
+            self.reading += 1
+            self.read_lock.release()
+
+            yield
+
+            self.read_lock.acquire()
+            self.reading -= 1
+            if self.reading == 0:
+                self.write_lock.release()
+            self.read_lock.release()
+
+    @contextmanager
+    def write(self):
+        with self._turnstile():
+            self.read_lock.acquire()
+            self.write_lock.acquire()
+            yield
+            self.write_lock.release()
+            self.read_lock.release()
+
+def bench_rwlock(ops: int = 40000, write_ratio: float = 0.05):
+    rows = [("threads", "impl", "ops/s")]
+    impls = [("p4_3 turnstile", TurnstileRWLock)]
+    impls += [(f"RWLock {p}", lambda p=p: RWLock(p)) for p in RWLock.POLICIES]
+    for n_threads in (4, 16, 64):
+        per_thread = ops // n_threads
+        for name, impl in impls:
+            rw = impl()
+            data = list("seahorse")
+
+            @thread()
+            def actor(seed: int):
+                rng = random.Random(seed)
+                for _ in range(per_thread):
+                    if rng.random() < write_ratio:
+                        with rw.write():
+                            rng.shuffle(data)
+                    else:
+                        with rw.read():
+                            "".join(data)
+
+            elapsed = timed([actor(i) for i in range(n_threads)])
+            rows.append((n_threads, name, per_thread * n_threads / elapsed))
+    report(f"Readers-writers ({1 - write_ratio:.0%} reads)", rows)
+
+
+# classic2.p4_1's consumer workload, at module level so it can be
+# sent to worker processes.
+def fact(i: int) -> int:
+    return 1 if i <= 2 else fact(i-1) + fact(i-2)
+
+def bench_process_stage(items: int = 200, size: int = 20):
+    rows = [("workers", "consumers", "items/s")]
+    for workers in (1, 2, 4, 8):
+        for mode in ("threads", "processes"):
+            source, sink = BoundedQueue(64), BoundedQueue()
+
+            @thread()
+            def producer():
+                source.put_many(size for _ in range(items))
+                source.close()
+
+            @thread()
+            def consumer():
+                for v in source:
+                    sink.put(fact(v))
+
+            if mode == "threads":
+                actors = [producer()] + [consumer() for _ in range(workers)]
+            else:
+                actors = [producer(), process_stage(source, fact, workers, batch=4, sink=sink)]
+            elapsed = timed(actors)
+            assert len(sink) == items
+            rows.append((workers, mode, items / elapsed))
+    report(f"CPU-bound consumers (fact({size}))", rows)
+
+
+# CPU burned by n students looking for a free room while the dean keeps
+# every room locked for `hold` seconds: advanced4.p7_3's old spin loop
+# against select_acquire.
+def bench_select(hold: float = 1.0):
+    rows = [("students", "impl", "cpu s / wall s")]
+    for n_students in (10, 200):
+        for impl in ("spin", "select_acquire"):
+            rooms = [Semaphore(0) for _ in range(5)]
+
+            @thread()
+            def student():
+                if impl == "spin":
+                    while not rooms[random.randrange(len(rooms))].acquire(blocking=False):
+                        pass
+                else:
+                    select_acquire(rooms)
+
+            @thread()
+            def dean():
+                sleep(hold)
+                for room in rooms:
+                    room.release(n_students)
+
+            cpu = process_time()
+            elapsed = timed([student() for _ in range(n_students)] + [dean()])
+            rows.append((n_students, impl, f"{(process_time() - cpu) / elapsed:.2f}"))
+    report("Waiting for any of 5 locked rooms", rows)
+
+
+"""
+intermediate3.p5_6's original recipe barrier: a semaphore per kind and
+one counter behind a shared mutex, kept as the baseline for
+bench_batch_barrier.
+"""
+class SemaphoreRecipe:
+    def __init__(self, recipe: dict):
+        self.recipe = recipe
+        self.total = sum(recipe.values())
+        self.count = 0
+        self.sems = {kind: Sem(n) for kind, n in recipe.items()}
+        self.mutex = Sem(1)
+
+    def arrive(self, kind, member=None):
+        self.sems[kind].acquire()
+        with self.mutex:
+            self.count += 1
+            if self.count == self.total:
+                self.count = 0
+                for k, n in self.recipe.items():
+                    self.sems[k].release(n)
+
+def bench_batch_barrier(batches: int = 2000):
+    rows = [("kinds", "impl", "arrivals/s")]
+    for n_kinds in (2, 12, 24):
+        recipe = {f"k{i}": 1 + i % 3 for i in range(n_kinds)}
+        for impl in (SemaphoreRecipe, BatchBarrier):
+            barrier = impl(recipe)
+
+            @thread()
+            def arriver(kind):
+                for _ in range(batches):
+                    barrier.arrive(kind)
+
+            actors = [arriver(kind) for kind, n in recipe.items() for _ in range(n)]
+            elapsed = timed(actors)
+            rows.append((n_kinds, impl.__name__, batches * len(actors) / elapsed))
+    report("Recipe batches", rows)
+
+
+# Loading a full bus the way advanced4.p7_4 used to (a syncB and an
+# acquire per rider) against Synchronizer.gather and acquire(n).
+def bench_boarding(loads: int = 200):
+    rows = [("seats", "impl", "loads/s")]
+    for seats in (10, 100):
+        for impl in ("per rider", "bulk"):
+            turnstile, boarding = Sem(0), Synchronizer()
+            boarded = FifoSemaphore(0)
+
+            @thread()
+            def passenger():
+                for _ in range(loads):
+                    turnstile.acquire()
+                    boarding.syncA()
+                    boarded.release()
+
+            @thread()
+            def bus():
+                for _ in range(loads):
+                    turnstile.release(seats)
+                    if impl == "bulk":
+                        boarding.gather(seats)
+                        boarded.acquire(n=seats)
+                    else:
+                        for _ in range(seats):
+                            boarding.syncB()
+                        for _ in range(seats):
+                            boarded.acquire()
+
+            elapsed = timed([passenger() for _ in range(seats)] + [bus()])
+            rows.append((seats, impl, loads / elapsed))
+    report("Bus boarding", rows)
+
+
+"""
+A gate that drains by polling: close() shuts out new visitors, then
+sleeps and rechecks the count until it reaches 0. Kept as the baseline
+for bench_gate.
+"""
+class PollingGate:
+    def __init__(self, poll: float = 1e-3):
+        self.poll = poll
+        self.count = 0
+        self.mutex = Sem(1)
+        self.turnstile = Sem(1)
+
+    def enter(self):
+        with self.turnstile:
+            pass
+        with self.mutex:
+            self.count += 1
+
+    def exit(self):
+        with self.mutex:
+            self.count -= 1
+
+    def close(self):
+        self.turnstile.acquire()
+        while True:
+            with self.mutex:
+                if self.count == 0:
+                    return True
+            sleep(self.poll)
+
+    def open(self):
+        self.turnstile.release()
+
+# Visitors streaming through a gate that a gatekeeper keeps closing for
+# exclusive maintenance: visit throughput and how long each close waited
+# for the gate to drain.
+def bench_gate(visits: int = 20000, closes: int = 200):
+    rows = [("visitors", "impl", "visits/s", "mean drain us", "max drain us")]
+    for n_visitors in (4, 16, 64):
+        per_visitor = visits // n_visitors
+        for impl in (PollingGate, Gate):
+            gate = impl()
+            drains = []
+            done = False
+
+            @thread()
+            def visitor():
+                for _ in range(per_visitor):
+                    gate.enter()
+                    gate.exit()
+
+            @thread()
+            def gatekeeper():
+                for _ in range(closes):
+                    if done:
+                        return
+                    start = perf_counter()
+                    gate.close()
+                    drains.append(perf_counter() - start)
+                    gate.open()
+                    sleep(1e-4)
+
+            keeper = gatekeeper().start()
+            elapsed = timed([visitor() for _ in range(n_visitors)])
+            done = True
+            keeper.join()
+            rows.append((n_visitors, impl.__name__, per_visitor * n_visitors / elapsed,
+                         f"{1e6 * sum(drains) / len(drains):.1f}", f"{1e6 * max(drains):.1f}"))
+    report("Gate drain", rows)
+
+
+"""
+advanced4.p6_1's original design: a plain linked list behind one Gate.
+Searchers and inserters enter the gate, inserters also share a mutex,
+and a delete closes the gate, stopping everyone until it's done. Kept as
+the baseline for bench_sidlist.
+"""
+class GateList:
+    def __init__(self, items=()):
+        self.gate = Gate()
+        self.insert_lock = Sem(1)
+        # nodes are [value, next]
+        self.head = [None, None]
+        self.tail = self.head
+        for item in items:
+            self.tail[1] = self.tail = [item, None]
+
+    def search(self, value) -> bool:
+        self.gate.enter()
+        node = self.head[1]
+        while node is not None and node[0] != value:
+            node = node[1]
+        self.gate.exit()
+        return node is not None
+
+    def insert(self, value):
+        self.gate.enter()
+        with self.insert_lock:
+            self.tail[1] = self.tail = [value, None]
+        self.gate.exit()
+
+    def delete(self, value) -> bool:
+        self.gate.close()
+        prev, node = self.head, self.head[1]
+        while node is not None and node[0] != value:
+            prev, node = node, node[1]
+        if node is not None:
+            prev[1] = node[1]
+            if node is self.tail:
+                self.tail = prev
+        self.gate.open()
+        return node is not None
+
+# 4 searchers, 2 inserters and 2 deleters hammering one list for
+# `duration` seconds, each looking for a random item.
+def bench_sidlist(duration: float = 1.0):
+    rows = [("items", "impl", "searches/s", "inserts/s", "deletes/s")]
+    for size in (1_000, 10_000, 100_000, 1_000_000):
+        for impl in (GateList, SIDList):
+            items = impl(range(size))
+            counts = {}
+            deadline = perf_counter() + duration
+
+            @thread()
+            def actor(kind: str, index: int):
+                rng = random.Random(index)
+                op = getattr(items, kind)
+                n = 0
+                while perf_counter() < deadline:
+                    op(rng.randrange(size) if kind != "insert" else size + index * 10**7 + n)
+                    n += 1
+                counts[index] = n
+
+            kinds = ["search"] * 4 + ["insert"] * 2 + ["delete"] * 2
+            elapsed = timed([actor(kind, i) for i, kind in enumerate(kinds)])
+            per_kind = {k: sum(n for i, n in counts.items() if kinds[i] == k) for k in ("search", "insert", "delete")}
+            rows.append((size, impl.__name__, *(n / elapsed for n in per_kind.values())))
+    report("Search-insert-delete list", rows)
+
+
+# Guests walking every room of a hall, `walkers` at a time, through
+# bonus5's preallocated Cascade and SparseCascade, and how much memory
+# the hall takes before anyone has entered.
+def bench_cascade(transitions: int = 200_000, walkers: int = 8):
+    rows = [("rooms", "impl", "guests/s", "rooms/s", "hall KB")]
+    for n_rooms in (10, 1_000, 100_000):
+        walks = max(1, transitions // (n_rooms * walkers))
+        for impl in (Cascade, SparseCascade):
+            tracemalloc.start()
+            hall = impl(n_rooms)
+            size = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+
+            @thread()
+            def guest():
+                for _ in range(walks):
+                    for i in range(n_rooms):
+                        hall.phase(i)
+                    hall.exit()
+
+            elapsed = timed([guest() for _ in range(walkers)])
+            guests = walks * walkers
+            rows.append((n_rooms, impl.__name__, f"{guests / elapsed:,.1f}", guests * n_rooms / elapsed, size / 1024))
+    report("Cascade walk", rows)
+
+
+# Waves of 8 items through `n_stages` stages of 4 workers, each taking
+# 4ms per item (1ms for the fast stages of the uneven run), one wave at
+# a time against CascadePipeline.
+def bench_pipeline(n_waves: int = 50, wave_size: int = 8):
+    rows = [("stages", "impl", "waves/s", "slowest stage bound")]
+    def stage(seconds: float):
+        return lambda item: sleep(seconds) or item
+    for label, times in (("4 even", [4e-3] * 4), ("4 uneven", [1e-3, 4e-3, 1e-3, 1e-3]), ("8 even", [4e-3] * 8)):
+        stages = [(stage(t), 4) for t in times]
+        items = list(range(n_waves * wave_size))
+        bound = 1 / (max(times) * wave_size / 4)
+        for impl in ("wave at a time", "CascadePipeline"):
+            start = perf_counter()
+            if impl == "CascadePipeline":
+                CascadePipeline(stages, wave_size).run(items)
+            else:
+                for w in range(n_waves):
+                    wave = items[w * wave_size:(w + 1) * wave_size]
+                    for fn, workers in stages:
+                        wave = map_parallel(fn, wave, workers, chunksize=1)
+            rows.append((label, impl, f"{n_waves / (perf_counter() - start):,.1f}", f"{bound:,.1f}"))
+    report("Wave pipeline", rows)
+
+
+# A one-permit semaphore shared by many low-priority threads and a few
+# high-priority ones, each holding it briefly: how long each class waits,
+# with FifoSemaphore's arrival order against PrioritySemaphore.
+def bench_priority(rounds: int = 200, hold: float = 1e-4):
+    rows = [("low/high threads", "impl", "low wait us", "high wait us")]
+    for n_low, n_high in ((16, 2), (64, 4)):
+        for impl in ("FifoSemaphore", "PrioritySemaphore"):
+            sem = FifoSemaphore(1) if impl == "FifoSemaphore" else PrioritySemaphore(1, levels=2)
+            waits = {0: [], 1: []}
+
+            @thread()
+            def user(priority: int):
+                for _ in range(rounds):
+                    start = perf_counter()
+                    if impl == "FifoSemaphore":
+                        sem.acquire()
+                    else:
+                        sem.acquire(priority=priority)
+                    waits[priority].append(perf_counter() - start)
+                    sleep(hold)
+                    sem.release()
+
+            timed([user(0) for _ in range(n_low)] + [user(1) for _ in range(n_high)])
+            rows.append((f"{n_low}/{n_high}", impl, *(f"{1e6 * sum(w) / len(w):,.0f}" for w in waits.values())))
+    report("Priority classes", rows)
+
+
+# Readers printing a 5-room occupancy array while writers move people
+# between rooms, for `duration` seconds: advanced4.p7_3's old lock per
+# room, taken in turn by every reader, against a SeqLock snapshot.
+def bench_snapshot(duration: float = 1.0, n_writers: int = 4, n_rooms: int = 5):
+    rows = [("readers", "impl", "snapshots/s", "writes/s")]
+    for n_readers in (1, 8, 32):
+        for impl in ("lock per room", "SeqLock"):
+            if impl == "SeqLock":
+                rooms = SeqLock([0] * n_rooms)
+            else:
+                rooms = [0] * n_rooms
+                locks = [Sem(1) for _ in range(n_rooms)]
+            counts = {}
+            deadline = perf_counter() + duration
+
+            @thread()
+            def reader(index: int):
+                n = 0
+                while perf_counter() < deadline:
+                    if impl == "SeqLock":
+                        rooms.read()
+                    else:
+                        snapshot = []
+                        for i in range(n_rooms):
+                            with locks[i]:
+                                snapshot.append(rooms[i])
+                    n += 1
+                counts[index] = n
+
+            @thread()
+            def writer(index: int):
+                rng = random.Random(index)
+                n = 0
+                while perf_counter() < deadline:
+                    i = rng.randrange(n_rooms)
+                    if impl == "SeqLock":
+                        with rooms.write() as r:
+                            r[i] += 1
+                    else:
+                        with locks[i]:
+                            rooms[i] += 1
+                    n += 1
+                counts[index] = n
+
+            # writers start first: threads started behind dozens of
+            # lock-free readers can wait most of a second for the GIL
+            elapsed = timed([writer(n_readers + i) for i in range(n_writers)]
+                            + [reader(i) for i in range(n_readers)])
+            reads = sum(counts[i] for i in range(n_readers))
+            rows.append((n_readers, impl, reads / elapsed, (sum(counts.values()) - reads) / elapsed))
+    report("Occupancy snapshots", rows)
+
+
+# classic2's readers and writers for `duration` seconds: 3 writers
+# reshuffling the data string, readers reading it through p4_2's
+# lightswitch (RWLock "readers"), p4_3's turnstile, or an RCUCell.
+def bench_rcu(duration: float = 1.0, n_writers: int = 3):
+    rows = [("readers", "impl", "reads/s", "writes/s")]
+    impls = ("p4_2 lightswitch", "p4_3 turnstile", "RCUCell get", "RCUCell read")
+    for n_readers in (1, 8, 64):
+        for impl in impls:
+            rw = RWLock("readers") if impl == "p4_2 lightswitch" else TurnstileRWLock()
+            data = "seahorse"
+            cell = RCUCell(data, on_retire=lambda old: None)
+            counts = {}
+            deadline = perf_counter() + duration
+
+            @thread()
+            def reader(index: int):
+                n = 0
+                while perf_counter() < deadline:
+                    if impl == "RCUCell get":
+                        cell.get()
+                    elif impl == "RCUCell read":
+                        with cell.read():
+                            pass
+                    else:
+                        with rw.read():
+                            data
+                    n += 1
+                counts[index] = n
+
+            @thread()
+            def writer(index: int):
+                nonlocal data
+                rng = random.Random(index)
+                shuffled = lambda s: "".join(rng.sample(s, len(s)))
+                n = 0
+                while perf_counter() < deadline:
+                    if impl.startswith("RCUCell"):
+                        cell.update(shuffled)
+                    else:
+                        with rw.write():
+                            data = shuffled(data)
+                    n += 1
+                    sleep(1e-4)
+                counts[index] = n
+
+            # writers start first, see bench_snapshot
+            elapsed = timed([writer(n_readers + i) for i in range(n_writers)]
+                            + [reader(i) for i in range(n_readers)])
+            reads = sum(counts[i] for i in range(n_readers))
+            rows.append((n_readers, impl, reads / elapsed, (sum(counts.values()) - reads) / elapsed))
+    report("Read-mostly string", rows)
+
+
+BENCHMARKS = {
+    "synchronizer": bench_synchronizer,
+    "barrier": bench_barrier,
+    "rwlock": bench_rwlock,
+    "process_stage": bench_process_stage,
+    "select": bench_select,
+    "batch_barrier": bench_batch_barrier,
+    "boarding": bench_boarding,
+    "gate": bench_gate,
+    "sidlist": bench_sidlist,
+    "cascade": bench_cascade,
+    "pipeline": bench_pipeline,
+    "priority": bench_priority,
+    "snapshot": bench_snapshot,
+    "rcu": bench_rcu,
+}
+
+if __name__ == "__main__":
+    for name in sys.argv[1:] or BENCHMARKS:
+        BENCHMARKS[name]()
@@ -0,0 +1,136 @@
+"""
+Headless runs of every problem, for catching throughput regressions.
+
+Each case runs in a fresh process with output discarded and the module's
+sleep() scaled down by --pace, so it mostly measures the synchronization
+rather than the pacing. Some pacing has to stay: without it p4_2's readers
+never leave the room and its writers starve. The problem is given a
+bounded size, every thread it starts is joined through a conc.Scope, and
+the run reports wall time, operations/sec and peak RSS.
+
+    python bench_problems.py --save baseline.json
+    python bench_problems.py --baseline baseline.json
+
+With --baseline, any case whose ops/s dropped by more than --tolerance
+is reported and the exit status is 1.
+"""
+
+import argparse
+import importlib
+import json
+import os
+import random
+import resource
+import sys
+import multiprocessing as mp
+from time import perf_counter, sleep
+
+import conc
+from bench import report
+
+# name: (module, function, kwargs, kwarg scaled by --scale, operations)
+CASES = {
+    "p3_3": ("basic1", "p3_3", {}, None, lambda p: 2),
+    "p3_6": ("basic1", "p3_6", {"n_instances": 64}, "n_instances", lambda p: p["n_instances"]),
+    "p3_7": ("basic1", "p3_7", {"n_instances": 6, "n_phases": 500}, "n_phases", lambda p: p["n_instances"] * p["n_phases"]),
+    "p4_1": ("classic2", "p4_1", {"w_max": 20}, "w_max", lambda p: p["w_max"] - 1),
+    "p4_2": ("classic2", "p4_2", {"n_cycles": 200}, "n_cycles", lambda p: p["n_cycles"]),
+    "p4_3": ("classic2", "p4_3", {"n_cycles": 200}, "n_cycles", lambda p: p["n_cycles"]),
+    "p5_4": ("intermediate3", "p5_4", {"n_customers": 200}, "n_customers", lambda p: p["n_customers"]),
+    # the haircuts/s figure quoted for the FifoSemaphore barbershop
+    "p5_4_1k": ("intermediate3", "p5_4", {"n_customers": 1000, "n_barbers": 16}, "n_customers", lambda p: p["n_customers"]),
+    "p5_6": ("intermediate3", "p5_6", {"n_atoms": 200}, "n_atoms", lambda p: p["n_atoms"]),
+    "p5_8": ("intermediate3", "p5_8", {"n": 500}, "n", lambda p: p["n"]),
+    "p6_1": ("advanced4", "p6_1", {"n_rounds": 500}, "n_rounds", lambda p: 12 * p["n_rounds"]),
+    "p7_3": ("advanced4", "p7_3", {"n": 50, "party": 10, "n_rounds": 100}, "n_rounds", lambda p: p["n"] * p["n_rounds"]),
+    "p7_4": ("advanced4", "p7_4", {"n_rounds": 50}, "n_rounds", lambda p: 20 * p["n_rounds"]),
+    "pb_1": ("bonus5", "pb_1", {"n_waves": 20}, "n_waves", lambda p: 4 * 7 * p["n_waves"]),
+    "pb_2": ("bonus5", "pb_2", {"n_waves": 20}, "n_waves", lambda p: 4 * 7 * p["n_waves"]),
+}
+
+def _run_case(name: str, scale: int, pace: float, conn):
+    module, fn, params, size, ops = CASES[name]
+    params = dict(params)
+    if size is not None:
+        params[size] *= scale
+
+    mod = importlib.import_module(module)
+    mod.sleep = lambda seconds: sleep(seconds * pace)
+    conc.trace.enabled = False
+    sys.stdout = open(os.devnull, "w")
+    random.seed(0)
+
+    start = perf_counter()
+    with conc.Scope():
+        getattr(mod, fn)(**params)
+    wall = perf_counter() - start
+    conn.send({
+        "wall_s": wall,
+        "ops": ops(params),
+        "ops_per_s": ops(params) / wall,
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    })
+
+def run_case(name: str, scale: int = 1, pace: float = 1e-3, timeout: float = 120) -> dict:
+    ctx = mp.get_context("spawn")
+    recv, send = ctx.Pipe(duplex=False)
+    proc = ctx.Process(target=_run_case, args=(name, scale, pace, send), daemon=True)
+    proc.start()
+    # so recv sees EOF at once if the child dies without sending
+    send.close()
+    result = {"error": "timeout"}
+    try:
+        if recv.poll(timeout):
+            result = recv.recv()
+    except EOFError:
+        proc.join()
+        result = {"error": f"exit code {proc.exitcode}"}
+    proc.kill()
+    proc.join()
+    return result
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    regressions = []
+    for name, r in results.items():
+        base = baseline.get(name)
+        if base is None or "ops_per_s" not in base:
+            continue
+        if "ops_per_s" not in r:
+            regressions.append(f"{name}: {r['error']}")
+        elif r["ops_per_s"] < base["ops_per_s"] * (1 - tolerance):
+            regressions.append(f"{name}: {r['ops_per_s']:,.0f} ops/s vs baseline {base['ops_per_s']:,.0f}")
+    return regressions
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("cases", nargs="*", default=list(CASES))
+    parser.add_argument("--scale", type=int, default=1)
+    parser.add_argument("--pace", type=float, default=1e-3)
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--save")
+    args = parser.parse_args(argv)
+
+    results = {name: run_case(name, args.scale, args.pace, args.timeout) for name in args.cases}
+    rows = [("problem", "wall s", "ops", "ops/s", "peak rss kb")]
+    for name, r in results.items():
+        if "error" in r:
+            rows.append((name, r["error"]))
+        else:
+            rows.append((name, f"{r['wall_s']:.3f}", r["ops"], r["ops_per_s"], r["peak_rss_kb"]))
+    report(f"Problems (scale {args.scale})", rows)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,14 +1,14 @@
 import random
 from collections import deque
-from threading import Semaphore as Sem
-from time import sleep
+from threading import Semaphore as Sem, Lock, Condition
+from time import sleep, perf_counter_ns
 from functools import reduce
 
-from conc import thread, Synchronizer, lock, semaphores, Gate, Lightswitch
+from conc import thread, Synchronizer, lock, semaphores, Gate, Lightswitch, trace, track, current_token, BoundedQueue, FifoSemaphore, PrioritySemaphore, SeqLock
 
 
-def out(label, msg, *a, **kw):
-    print(f"{label}: {msg}", *a, **kw, flush=True)
+def out(label, msg):
+    trace.event(label, msg)
 
 """
 Bonus 1
@@ -35,16 +35,25 @@ cannot be opened as long as the exit has not been closed.
 In addition, we can supply a transition function to perform actions
 in between leaving the previous room and entering the next. We use this
 to update the state of the museum in a mutually-exclusive way that respects
-our system of transitions.
+our system of transitions. The state is a SeqLock, so printing it takes a
+snapshot without holding up the next transition.
 """
 
 class Cascade:
-    def __init__(self, phases):
+    def __init__(self, phases, name: str = None, levels: int = 1):
         self._phases = phases
-        self._sems = [Sem(1) for _ in range(phases)]
-        self._switches = [Lightswitch() for _ in range(phases)]
-
-    def phase(self, phase: int, f=None):
+        self._levels = levels
+        # with levels > 1, entrants waiting on a door with a higher priority
+        # go through first
+        if levels > 1:
+            self._sems = [PrioritySemaphore(1, levels) for _ in range(phases)]
+        else:
+            self._sems = [Sem(1) for _ in range(phases)]
+        self._stats = track("Cascade", name, self)
+        name = name or f"Cascade@{id(self):x}"
+        self._switches = [Lightswitch(f"{name}.switch[{i}]") for i in range(phases)]
+
+    def phase(self, phase: int, f=None, priority: int = 0):
         # lock phase we just exited
         if phase > 0:
             self._switches[phase-1].lock(self._sems[phase-1])
@@ -57,21 +66,207 @@ class Cascade:
             self._switches[phase-2].unlock(self._sems[phase-2])
         
         # enter this phase
-        self._sems[phase].acquire()
-        self._sems[phase].release()
+        door = self._sems[phase]
+        if self._levels > 1:
+            if self._stats is None:
+                door.acquire(priority=priority)
+            else:
+                start = perf_counter_ns()
+                door.acquire(priority=priority)
+                self._stats.waited(perf_counter_ns() - start)
+        elif priority != 0:
+            raise ValueError("priority must be 0 in a Cascade with levels=1")
+        elif self._stats is None:
+            door.acquire()
+        else:
+            self._stats.acquire(door)
+        door.release()
 
 
     def exit(self):
         self._switches[-2].unlock(self._sems[-2])
 
-def pb_1():
-    n_rooms = 7
-    n_guests = 4
-    n_waves = 5
+"""
+Cascade for halls too big to build up front. A room's state only exists
+while someone is in it, so 100k rooms cost memory in proportion to the
+occupied ones, and phases=None gives a hall with no last room at all.
+Entering a room waits for the room ahead to empty; every occupancy of a
+room gets a fresh state object, which retires (and wakes everyone
+waiting on it with one broadcast) when the last guest leaves, so a crowd
+goes through together instead of passing a semaphore along one by one.
+Guests can leave from any room with exit(phase).
+"""
+class _Room:
+    __slots__ = ("count", "emptied")
+
+    def __init__(self):
+        self.count = 0
+        # created by the first guest to wait on this room
+        self.emptied = None
+
+class SparseCascade:
+    def __init__(self, phases: int = None, name: str = None, stripes: int = 64):
+        self._phases = phases
+        self._rooms = {}
+        # a room's entry in _rooms is only touched under its stripe
+        self._stripes = [Lock() for _ in range(stripes)]
+        self._stats = track("SparseCascade", name, self)
+
+    def _stripe(self, phase: int) -> Lock:
+        return self._stripes[phase % len(self._stripes)]
+
+    def _check(self, phase: int):
+        if phase < 0 or (self._phases is not None and phase >= self._phases):
+            raise ValueError(f"no phase {phase} in a cascade of {self._phases}")
+
+    def _enter(self, phase: int):
+        with self._stripe(phase):
+            room = self._rooms.get(phase)
+            if room is None:
+                room = self._rooms[phase] = _Room()
+            room.count += 1
+
+    def _leave(self, phase: int):
+        with self._stripe(phase):
+            room = self._rooms.get(phase)
+            if room is None:
+                raise RuntimeError(f"left phase {phase}, which nobody is in")
+            room.count -= 1
+            if room.count == 0:
+                del self._rooms[phase]
+                if room.emptied is not None:
+                    room.emptied.notify_all()
+
+    def _wait_empty(self, phase: int):
+        stripe = self._stripe(phase)
+        with stripe:
+            room = self._rooms.get(phase)
+            if room is None:
+                if self._stats is not None:
+                    self._stats.waited(0)
+                return
+            if room.emptied is None:
+                room.emptied = Condition(stripe)
+            start = perf_counter_ns()
+            token = current_token()
+            if token is None:
+                while room.count:
+                    room.emptied.wait()
+            else:
+                token.wait_for(room.emptied, lambda: room.count == 0)
+        if self._stats is not None:
+            self._stats.waited(perf_counter_ns() - start)
 
+    def phase(self, phase: int, f=None):
+        self._check(phase)
+        self._enter(phase)
+        # transition function, just before the prior phase is left
+        if f is not None: f()
+        if phase > 0:
+            self._leave(phase-1)
+        if self._phases is None or phase + 1 < self._phases:
+            self._wait_empty(phase+1)
+
+    def exit(self, phase: int = None):
+        if phase is None:
+            if self._phases is None:
+                raise ValueError("exit() needs a phase when the cascade has no last phase")
+            phase = self._phases - 1
+        self._check(phase)
+        self._leave(phase)
+
+    # number of rooms with someone in them
+    def __len__(self):
+        return len(self._rooms)
+
+"""
+Ordered, pipelined batch processing on a cascade. Each stage is a
+function run by its own pool of workers, and items go through the stages
+in waves of wave_size, like the guests in pb_1. Each wave walks a
+SparseCascade and is worked on by stage k in room 3k, so a stage never
+has two waves in it at once. A wave can only enter a room once the room
+ahead is empty, which keeps waves two rooms apart; the two buffer rooms
+after each stage, where a finished wave waits for the next stage to
+clear, let neighbouring stages work on neighbouring waves at the same
+time. Throughput then approaches the slowest stage's rather than the sum
+of all stages.
+
+    pipeline = CascadePipeline([(parse, 4), (score, 8), (store, 1)], wave_size=32)
+    results = pipeline.run(records)
+
+run() returns the results in input order. An item whose stage raised
+skips the remaining stages, and run() raises the first such exception
+once everything has drained.
+"""
+class CascadePipeline:
+    def __init__(self, stages: list[tuple], wave_size: int = 16):
+        if not stages:
+            raise ValueError("pipeline needs at least one stage")
+        if wave_size < 1:
+            raise ValueError("wave_size must be at least 1")
+        self.stages = stages
+        self.wave_size = wave_size
+
+    def run(self, items) -> list:
+        results = list(items)
+        n_stages = len(self.stages)
+        hall = SparseCascade(3 * n_stages - 2)
+        inboxes = [BoundedQueue() for _ in self.stages]
+        errors = {}
+        # released by each wave once it has left the first room, so the
+        # next one can come in
+        cleared = Sem(0)
+
+        @thread()
+        def worker(k: int):
+            fn = self.stages[k][0]
+            for index, done in inboxes[k]:
+                if index not in errors:
+                    try:
+                        results[index] = fn(results[index])
+                    except Exception as e:
+                        errors[index] = e
+                done.release()
+
+        # a wave goes through the hall as one guest, handing its items to
+        # each stage's workers in turn; waiting in the buffer rooms only
+        # holds up this thread, not the workers
+        @thread()
+        def wave(start: int, end: int):
+            done = FifoSemaphore(0)
+            for k in range(n_stages):
+                hall.phase(3 * k)
+                inboxes[k].put_many((index, done) for index in range(start, end))
+                done.acquire(n=end - start)
+                if k + 1 < n_stages:
+                    hall.phase(3 * k + 1)
+                    if k == 0:
+                        cleared.release()
+                    hall.phase(3 * k + 2)
+            hall.exit()
+            if n_stages == 1:
+                cleared.release()
+
+        workers = [worker(k).start() for k, (_, n) in enumerate(self.stages) for _ in range(n)]
+        waves = []
+        for start in range(0, len(results), self.wave_size):
+            if waves:
+                cleared.acquire()
+            waves.append(wave(start, min(start + self.wave_size, len(results))).start())
+        for t in waves:
+            t.join()
+        for inbox in inboxes:
+            inbox.close()
+        for t in workers:
+            t.join()
+        if errors:
+            raise errors[min(errors)]
+        return results
+
+def pb_1(n_rooms=7, n_guests=4, n_waves=5):
     hall = Cascade(n_rooms)
-    state_mutex = Sem(1)
-    state = ["" for _ in range(n_rooms)]
+    # rewritten by one transition at a time, printed without locking
+    state = SeqLock("" for _ in range(n_rooms))
     waves = [Sem(1), *(Sem(0) for _ in range(n_waves))]
 
     ready_count = [n_guests for _ in range(n_waves)]
@@ -82,19 +277,16 @@ def pb_1():
     def guest(wave, num, phases: int):
         lbl = f'[{wave} {num}]'
         wave_num = wave
-        wave = chr(ord('A')+w)
+        wave = chr(ord('A')+wave_num)
 
         def transition(i: int):
-            state_mutex.acquire()
-            if i > 0:
-                state[i-1] = state[i-1].removesuffix(wave)
-            if i < n_rooms:
-                out(lbl, f"entered room {i}")
-                state[i] = wave + state[i]
-            else:
-                out(lbl, f"exit")
-            print(state)
-            state_mutex.release()
+            with state.write() as rooms:
+                if i > 0:
+                    rooms[i-1] = rooms[i-1].removesuffix(wave)
+                if i < n_rooms:
+                    rooms[i] = wave + rooms[i]
+            out(lbl, f"entered room {i}" if i < n_rooms else "exit")
+            out(lbl, state.read())
 
         # ========================================    
         # For demonstration purposes, we coordinate guests
@@ -126,9 +318,9 @@ def pb_1():
                 pass
         hall.exit()
             
-    for w in range(n_waves):
-        for i in range(n_guests):
-            guest(w, i, n_rooms).start()
+    return [guest(w, i, n_rooms).start()
+            for w in range(n_waves)
+            for i in range(n_guests)]
 
 # pb_1()
 
@@ -151,22 +343,30 @@ Thanks to our Cascade abstraction, we can introduce the vip threads
 with minimal modification to existing code.  As long as we ensure the
 following threads only enter once a vip is in the second room, the cascade
 ensures the constraints are respected.
-"""
 
-def pb_2():
-    n_rooms = 7
-    n_guests = 4
-    n_waves = 5
+Entry to the first two rooms is a PrioritySemaphore held by one wave, or
+one VIP, at a time. A waiting VIP goes ahead of waiting waves, and keeps
+that priority at every door of the hall, while aging stops a run of VIPs
+from holding the waves back for good. Each wave takes the semaphore once,
+so guests no longer queue on it one by one.
+"""
 
-    hall = Cascade(n_rooms)
-    state_mutex = Sem(1)
-    state = ["" for _ in range(n_rooms)]
+def pb_2(n_rooms=7, n_guests=4, n_waves=5):
+    hall = Cascade(n_rooms, levels=2)
+    # rewritten by one transition at a time, printed without locking
+    state = SeqLock("" for _ in range(n_rooms))
     waves = [Sem(1), *(Sem(0) for _ in range(n_waves))]
 
     ready_count = [n_guests for _ in range(n_waves)]
     ready = [Sem(0) for _ in range(n_waves)]
 
-    reservation = Sem(1)
+    VIP = 1
+    ingress = PrioritySemaphore(1, levels=2)
+    # the first guest of a wave to arrive takes ingress for all of it,
+    # and the last one through the second room gives it back
+    arrived = [0 for _ in range(n_waves)]
+    admitted = [Sem(0) for _ in range(n_waves)]
+    through = [0 for _ in range(n_waves)]
 
     @thread()
     def vip(n, phases: int):
@@ -174,27 +374,24 @@ def pb_2():
         wave = '*'
 
         def transition(i: int):
-            state_mutex.acquire()
-            if i > 0:
-                state[i-1] = state[i-1].removesuffix(wave)
-            if i < n_rooms:
-                out(lbl, f"entered room {i}")
-                state[i] = wave + state[i]
-            else:
-                out(lbl, f"exit")
-            print(state)
-            state_mutex.release()
+            with state.write() as rooms:
+                if i > 0:
+                    rooms[i-1] = rooms[i-1].removesuffix(wave)
+                if i < n_rooms:
+                    rooms[i] = wave + rooms[i]
+            out(lbl, f"entered room {i}" if i < n_rooms else "exit")
+            out(lbl, state.read())
         
         sleep(random.random())
-        reservation.acquire()
+        ingress.acquire(priority=VIP)
 
-        hall.phase(0, lambda: transition(0))
-        hall.phase(1, lambda: transition(1))
-        reservation.release()
+        hall.phase(0, lambda: transition(0), priority=VIP)
+        hall.phase(1, lambda: transition(1), priority=VIP)
+        ingress.release()
 
         for i in range(2, phases):
             sleep(random.random())
-            hall.phase(i, lambda: transition(i))
+            hall.phase(i, lambda: transition(i), priority=VIP)
         hall.exit()
     
     
@@ -202,27 +399,29 @@ def pb_2():
     def guest(wave, num, phases: int):
         lbl = f'[{wave} {num}]'
         wave_num = wave
-        wave = chr(ord('A')+w)
+        wave = chr(ord('A')+wave_num)
 
         def transition(i: int):
-            state_mutex.acquire()
-            if i > 0:
-                state[i-1] = state[i-1].removesuffix(wave)
-            if i < n_rooms:
-                out(lbl, f"entered room {i}")
-                state[i] = wave + state[i]
-            else:
-                out(lbl, f"exit")
-            print(state)
-            state_mutex.release()
+            with state.write() as rooms:
+                if i > 0:
+                    rooms[i-1] = rooms[i-1].removesuffix(wave)
+                if i < n_rooms:
+                    rooms[i] = wave + rooms[i]
+            out(lbl, f"entered room {i}" if i < n_rooms else "exit")
+            out(lbl, state.read())
 
         if wave_num > 0:
             waves[wave_num].acquire()
             waves[wave_num].release()
 
         # let vips skip the line
-        reservation.acquire()
-        reservation.release()
+        with lock(wave):
+            arrived[wave_num] += 1
+            first = arrived[wave_num] == 1
+        if first:
+            ingress.acquire()
+            admitted[wave_num].release(n_guests)
+        admitted[wave_num].acquire()
 
         hall.phase(0, lambda: transition(0))
 
@@ -233,6 +432,10 @@ def pb_2():
                 
         ready[wave_num].acquire()
         hall.phase(1, lambda: transition(1))
+        with lock(wave):
+            through[wave_num] += 1
+            if through[wave_num] == n_guests:
+                ingress.release()
         waves[wave_num+1].release()
 
         for i in range(2, phases):
@@ -240,15 +443,15 @@ def pb_2():
             hall.phase(i, lambda: transition(i))
         hall.exit()
             
+    threads = []
     v = 0
     for w in range(n_waves):
         for i in range(n_guests):
-            guest(w, i, n_rooms).start()
-        reservation.acquire()
-        reservation.release()
+            threads.append(guest(w, i, n_rooms).start())
 
         if random.random() > 0.5:
-            vip(v, n_rooms).start()
+            threads.append(vip(v, n_rooms).start())
             v += 1
+    return threads
 
 # pb_2
\ No newline at end of file
@@ -1,7 +1,7 @@
 from threading import Semaphore as Sem
 from time import sleep
 import random
-from conc import thread
+from conc import thread, BoundedQueue
 
 
 """
@@ -10,59 +10,48 @@ from conc import thread
 Producers create things, Consumers consume things.
 """
 
-def p4_1():
-    q = []
+def p4_1(w_max=20, n_prods=7, n_coms=3):
+    q = BoundedQueue(5)
     access = Sem(1)
-    ready = Sem(0)
     work = 1
-    w_max = 20
-    n_prods = 7
-    n_coms = 3
-    done = False
+    producing = n_prods
 
     @thread()
     def producer(label: str):
-        nonlocal done
         nonlocal work
+        nonlocal producing
         while True:
             sleep(0.2) # pretend to calculate something
             access.acquire()
             if work >= w_max:
-                done = True
-                ready.release()
+                # the last producer out closes the queue, which
+                # lets consumers finish once it's drained
+                producing -= 1
+                if producing == 0:
+                    q.close()
                 access.release()
                 print(f"{label} done")
                 return
             v = work
             work += 1
-            q.append((label, v))
-            ready.release()
             access.release()
+            q.put((label, v))
 
 
     @thread()
     def consumer(label: str):
         def fact(i):
             return 1 if i <= 2 else fact(i-1) + fact(i-2)
-        nonlocal done
-        while True:
-            ready.acquire()
-            access.acquire()
-            if done:
-                ready.release()
-                access.release()
-                print(f"{label} done")
-                return
-            p, v = q.pop()
-            access.release()
-            result = fact(v)
+        answers = {}
+        for p, v in q:
+            result = answers[v] = fact(v)
             print(f"{label} got request {v} from {p}, answer: {result}")
+        print(f"{label} done")
+        return answers
 
-    for i in range(n_coms):
-        consumer(f"[con {i}]").start()
-    
-    for i in range(n_prods):
-        producer(f"[prd {i}]").start()
+    consumers = [consumer(f"[con {i}]").start() for i in range(n_coms)]
+    producers = [producer(f"[prd {i}]").start() for i in range(n_prods)]
+    return consumers + producers
 
 
 """
@@ -74,10 +63,7 @@ or exactly one writer can have exclusive access.
 
 """
 
-def p4_2():
-    n_writers = 3
-    n_readers = 10
-    n_cycles = 10
+def p4_2(n_writers=3, n_readers=10, n_cycles=10):
 
     write_lock = Sem(1)
     read_lock = Sem(1)
@@ -123,19 +109,20 @@ def p4_2():
                 read_lock.release()
                 return
             n_cycles -= 1
+            # readers need read_lock to leave, so it can't be held
+            # while waiting for them to let go of write_lock
+            read_lock.release()
             write_lock.acquire()
             d = list(data)
             random.shuffle(d)
             d = "".join(d)
             data = d
             write_lock.release()
-            read_lock.release()
             print(f"{label} wrote {str(d)}")
 
-    for i in range(n_readers):
-        reader(f"[reader {i}]").start()
-    for i in range(n_writers):
-        writer(f"[writer {i}]").start()
+    readers = [reader(f"[reader {i}]").start() for i in range(n_readers)]
+    writers = [writer(f"[writer {i}]").start() for i in range(n_writers)]
+    return readers + writers
 
 
 """
@@ -151,10 +138,7 @@ it with a 2-layer turnstile. We use this to guard the acquisition of
 the read_lock so that everyone is guaranteed a turn with it.
 """
 
-def p4_3():
-    n_writers = 3
-    n_readers = 10
-    n_cycles = 10
+def p4_3(n_writers=3, n_readers=10, n_cycles=10):
 
     write_lock = Sem(1)
     read_lock = Sem(1)
@@ -247,7 +231,6 @@ def p4_3():
             if turnstile(write):
                 return
 
-    for i in range(n_readers):
-        reader(f"[reader {i}]").start()
-    for i in range(n_writers):
-        writer(f"[writer {i}]").start()
\ No newline at end of file
+    readers = [reader(f"[reader {i}]").start() for i in range(n_readers)]
+    writers = [writer(f"[writer {i}]").start() for i in range(n_writers)]
+    return readers + writers
\ No newline at end of file
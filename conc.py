@@ -1,135 +1,1885 @@
-from threading import Thread, Semaphore
+import atexit
+import json
+import struct
+import sys
+import random
+import threading
+import traceback
+from threading import Thread, Lock, Condition, Event, BrokenBarrierError, local, current_thread
+from time import time_ns, perf_counter_ns, monotonic, sleep as _sleep
 from collections import deque
+from heapq import heappush, heappop
+from itertools import count, takewhile
+from concurrent.futures import Executor, Future, ThreadPoolExecutor, ProcessPoolExecutor, wait
+from contextlib import contextmanager, nullcontext
+from queue import Empty, Full
 from typing import Hashable, Generator
 
+"""
+Thread that keeps its target's return value or exception, so callers can
+collect it with result()/exception() like a future. Exceptions are still
+raised in the thread as well, so they get reported as usual.
+"""
 class CustomThread(Thread):
+    _scope = None
+    _result = None
+    _exception = None
+
     def start(self):
+        self._scope = _current_scope()
+        if self._scope is not None:
+            self._scope._track(self)
         super().start()
         return self
 
-def thread(**kw):
+    def run(self):
+        _run_in_scope(self._scope, self._capture)
+
+    def _capture(self):
+        try:
+            if self._target is not None:
+                self._result = self._target(*self._args, **self._kwargs)
+        except BaseException as e:
+            self._exception = e
+            raise
+        finally:
+            del self._target, self._args, self._kwargs
+
+    def _wait(self, timeout):
+        self.join(timeout)
+        if self.is_alive():
+            raise TimeoutError("thread still running")
+
+    def result(self, timeout: float = None):
+        self._wait(timeout)
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout: float = None) -> BaseException | None:
+        self._wait(timeout)
+        return self._exception
+
+"""
+Handle for a call submitted to a worker pool. Mirrors CustomThread:
+start() submits and returns the handle, join() blocks until the body has
+finished, and result()/exception() hand back its outcome.
+"""
+class PooledTask:
+    def __init__(self, executor: Executor, target):
+        self._executor = executor
+        self._target = target
+        self._future = None
+
+    def start(self):
+        if self._future is not None:
+            raise RuntimeError("tasks can only be started once")
+        scope = _current_scope()
+        if scope is not None:
+            scope._track(self)
+        self._future = self._executor.submit(_run_in_scope, scope, self._target)
+        return self
+
+    def _started(self) -> Future:
+        if self._future is None:
+            raise RuntimeError("cannot join task before it is started")
+        return self._future
+
+    def join(self, timeout=None):
+        wait([self._started()], timeout)
+
+    def is_alive(self):
+        return self._future is not None and not self._future.done()
+
+    def result(self, timeout: float = None):
+        return self._started().result(timeout)
+
+    def exception(self, timeout: float = None) -> BaseException | None:
+        return self._started().exception(timeout)
+
+# thread(pool=N) runs calls on a bounded set of N reusable workers
+# instead of one new thread per call. pool may also be an existing
+# Executor to share workers between several decorated functions.
+# Bodies that block waiting on each other must fit in the pool,
+# or the ones left queued behind them will never get a worker.
+# Pool workers are shared, so the only Thread option they take is
+# name, as their name prefix, and only for a pool this call creates.
+def thread(pool: int | Executor | None = None, **kw):
+    if pool is not None:
+        unsupported = set(kw) - ({"name"} if isinstance(pool, int) else set())
+        if unsupported:
+            raise TypeError(f"thread(pool=...) does not support {', '.join(sorted(unsupported))}")
+
     def wrap(f):
+        if pool is None:
+            def inner(*ai, **kwi):
+                return CustomThread(target=lambda: f(*ai, **kwi), **kw)
+            return inner
+
+        executor = pool
+        if not isinstance(executor, Executor):
+            executor = ThreadPoolExecutor(
+                max_workers=pool,
+                thread_name_prefix=kw.get("name", f.__name__))
+
         def inner(*ai, **kwi):
-            return CustomThread(target=lambda: f(*ai, **kwi), **kw)
+            return PooledTask(executor, lambda: f(*ai, **kwi))
         return inner
     return wrap
 
+def _chunks(iterable, size: int):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+# [fn(x) for x in iterable], computed by a pool of worker threads that
+# each take chunksize items at a time, so large inputs don't cost a
+# thread or a future per item. Results keep the input order.
+def map_parallel(fn, iterable, workers: int = 8, chunksize: int = 256) -> list:
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="map_parallel") as executor:
+        @thread(pool=executor)
+        def run_chunk(chunk: list) -> list:
+            return [fn(item) for item in chunk]
+
+        handles = [run_chunk(chunk).start() for chunk in _chunks(iterable, chunksize)]
+        return [r for handle in handles for r in handle.result()]
+
+class Cancelled(Exception):
+    pass
+
+"""
+Cooperative cancellation flag shared by everything running in a Scope.
+Blocking calls made through the token register a waker with it, which
+cancel() calls, so a cancelled actor wakes up at once and raises
+Cancelled while idle waiters cost nothing. Only semaphores from outside
+conc can't be woken that way; acquire() polls those every poll seconds.
+cancel() must not be called while holding a lock someone is waiting on
+through the token.
+"""
+class CancelToken:
+    def __init__(self, poll: float = 0.05):
+        self.poll = poll
+        self._event = Event()
+        self._wakers = set()
+        self._mutex = Lock()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def cancel(self):
+        with self._mutex:
+            self._event.set()
+            wakers, self._wakers = self._wakers, set()
+        for wake in wakers:
+            wake()
+
+    def check(self):
+        if self._event.is_set():
+            raise Cancelled()
+
+    # has cancel() call wake() while the block runs; check afterwards, in
+    # case it was cancelled before registering
+    @contextmanager
+    def _waking(self, wake):
+        with self._mutex:
+            self._wakers.add(wake)
+        try:
+            yield
+        finally:
+            with self._mutex:
+                self._wakers.discard(wake)
+
+    def acquire(self, sem):
+        self.check()
+        while not sem.acquire(timeout=self.poll):
+            self.check()
+
+    # cond must be held; waits until predicate() is true
+    def wait_for(self, cond: Condition, predicate):
+        if predicate():
+            return
+        def wake():
+            with cond:
+                cond.notify_all()
+        with self._waking(wake):
+            while not predicate():
+                self.check()
+                cond.wait()
+
+    # waits for a single-use ticket lock that another thread releases to
+    # hand something over. On cancel, withdraw() takes the ticket out of
+    # line, returning False if it was handed over already, and the wait
+    # ends with Cancelled.
+    def _wait_ticket(self, ticket: Lock, withdraw):
+        withdrawn = False
+        def wake():
+            nonlocal withdrawn
+            if withdraw():
+                withdrawn = True
+                ticket.release()
+        with self._waking(wake):
+            if self.cancelled:
+                wake()
+            ticket.acquire()
+        if withdrawn:
+            raise Cancelled()
+
+    def sleep(self, seconds: float):
+        if self._event.wait(seconds):
+            raise Cancelled()
+
+"""
+Structured concurrency for actors. Every @thread() call started while
+the scope is active, directly or from one of its threads, is tracked and
+shares the scope's CancelToken, and conc's blocking calls in those
+threads give up with Cancelled once it is cancelled. Leaving the scope
+joins everything: it waits up to timeout seconds for threads to finish
+on their own (forever if None), then cancels and allows grace more
+seconds before reporting the stragglers.
+
+    with Scope(timeout=10) as scope:
+        p7_4(n_rounds=None)
+"""
+class Scope:
+    def __init__(self, timeout: float = None, grace: float = 1.0, poll: float = 0.05):
+        self.timeout = timeout
+        self.grace = grace
+        self.token = CancelToken(poll)
+        self._threads = []
+        self._mutex = Lock()
+        self._outer = None
+
+    def _track(self, t):
+        with self._mutex:
+            self._threads.append(t)
+
+    def cancel(self):
+        self.token.cancel()
+
+    def _join(self, timeout: float | None) -> list:
+        deadline = None if timeout is None else monotonic() + timeout
+        while True:
+            with self._mutex:
+                alive = [t for t in self._threads if t.is_alive()]
+                self._threads = alive
+            if not alive:
+                return []
+            if deadline is not None and monotonic() >= deadline:
+                return alive
+            for t in alive:
+                t.join(None if deadline is None else max(0, deadline - monotonic()))
+
+    def __enter__(self):
+        self._outer = _current_scope()
+        _scope_local.scope = self
+        return self
+
+    def __exit__(self, type, val, traceback):
+        _scope_local.scope = self._outer
+        if type is not None:
+            self.cancel()
+        if self._join(self.timeout):
+            self.cancel()
+            leaked = self._join(self.grace)
+            if leaked and type is None:
+                raise RuntimeError(f"{len(leaked)} threads still running after cancelling the scope")
+        return type is Cancelled
+
+_scope_local = local()
+
+def _current_scope() -> Scope | None:
+    return getattr(_scope_local, "scope", None)
+
+def _run_in_scope(scope: Scope | None, target):
+    if scope is None:
+        return target()
+    _scope_local.scope = scope
+    try:
+        return target()
+    except Cancelled:
+        pass
+    finally:
+        _scope_local.scope = None
+
+def current_token() -> CancelToken | None:
+    scope = _current_scope()
+    return None if scope is None else scope.token
+
+"""
+Counting semaphore like threading.Semaphore, waiting on its own Condition
+so a cancelled CancelToken can wake the waiters. acquire() ignores Scopes,
+which suits conc's internal mutexes: a wait through _acquire() gives up
+with Cancelled, cleanup paths that call acquire() are never interrupted.
+"""
+class _Semaphore:
+    def __init__(self, value: int = 1):
+        if value < 0:
+            raise ValueError("semaphore initial value must be >= 0")
+        self._value = value
+        self._cond = Condition(Lock())
+
+    def acquire(self, blocking: bool = True, timeout: float = None) -> bool:
+        with self._cond:
+            if not self._value:
+                if not blocking:
+                    return False
+                if not self._cond.wait_for(lambda: self._value, timeout):
+                    return False
+            self._value -= 1
+            return True
+
+    def _acquire_cancellable(self, token: CancelToken):
+        with self._cond:
+            token.wait_for(self._cond, lambda: self._value)
+            self._value -= 1
+
+    def release(self, n: int = 1):
+        with self._cond:
+            self._value += n
+            self._cond.notify(n)
+
+    __enter__ = acquire
+
+    def __exit__(self, type, val, traceback):
+        self.release()
+
+"""
+Semaphore whose blocking acquire() gives up with Cancelled when the
+calling thread's Scope is cancelled, and whose release() wakes any
+select_acquire() waiting on it. Outside a Scope and without selectors it
+behaves like threading.Semaphore.
+"""
+class Semaphore(_Semaphore):
+    def __init__(self, value: int = 1):
+        super().__init__(value)
+        self._selectors = set()
+
+    def release(self, n: int = 1):
+        super().release(n)
+        if self._selectors:
+            for selector in list(self._selectors):
+                selector.set()
+
+    def acquire(self, blocking: bool = True, timeout: float = None) -> bool:
+        if blocking and timeout is None:
+            token = current_token()
+            if token is not None:
+                self._acquire_cancellable(token)
+                return True
+        return super().acquire(blocking, timeout)
+
+    __enter__ = acquire
+
+"""
+Counting semaphore that hands permits to waiters strictly in the order
+they called acquire(). A release with someone waiting passes the permit
+straight to the longest waiter and wakes only that thread, so there are
+no spurious wakeups and no barging by newcomers.
+
+acquire(n=k) takes k permits atomically: the caller sleeps until k have
+been released to it and is woken once, rather than once per permit.
+"""
+class FifoSemaphore:
+    def __init__(self, value: int = 1):
+        self._value = value
+        self._waiters = deque() # (permits needed, ticket)
+        self._mutex = Lock()
+
+    def acquire(self, blocking: bool = True, timeout: float = None, n: int = 1) -> bool:
+        with self._mutex:
+            if self._value >= n and not self._waiters:
+                self._value -= n
+                return True
+            if not blocking:
+                return False
+            ticket = Lock()
+            ticket.acquire()
+            self._waiters.append((n, ticket))
+        if timeout is None:
+            _acquire(ticket, lambda: self._withdraw(n, ticket))
+            return True
+        if ticket.acquire(timeout=timeout):
+            return True
+        if self._withdraw(n, ticket):
+            return False
+        return True
+
+    # takes ticket out of line; False if it was already handed its permits
+    def _withdraw(self, n: int, ticket: Lock) -> bool:
+        with self._mutex:
+            if (n, ticket) not in self._waiters:
+                return False
+            self._waiters.remove((n, ticket))
+            # whoever was queued behind may be satisfiable now
+            self._dispatch()
+            return True
+
+    def _dispatch(self):
+        while self._waiters and self._value >= self._waiters[0][0]:
+            n, ticket = self._waiters.popleft()
+            self._value -= n
+            ticket.release()
+
+    def release(self, n: int = 1):
+        with self._mutex:
+            self._value += n
+            self._dispatch()
+
+    __enter__ = acquire
+
+    def __exit__(self, type, val, traceback):
+        self.release()
+
+"""
+Semaphore that serves waiters by priority class instead of arrival
+order: acquire(priority=p), with p in range(levels), higher first. So a
+steady stream of high-priority callers can't starve everyone else,
+waiters age: every `aging` seconds spent waiting counts as one class,
+so a waiter is only overtaken by callers arriving less than
+(their priority - its priority) * aging seconds after it. Waiters sit in
+a heap keyed on that, so picking the next one is O(log n). As with
+FifoSemaphore, a release hands the permits straight to the chosen
+waiter and wakes only that thread, and acquire(n=k) takes k at once.
+"""
+class PrioritySemaphore:
+    def __init__(self, value: int = 1, levels: int = 2, aging: float = 1.0):
+        self.levels = levels
+        self.aging = aging
+        self._value = value
+        # heap of [key, seq, permits needed, ticket, still waiting]
+        self._waiters = []
+        self._waiting = 0
+        self._seq = count()
+        self._mutex = Lock()
+
+    def acquire(self, blocking: bool = True, timeout: float = None, priority: int = 0, n: int = 1) -> bool:
+        if not 0 <= priority < self.levels:
+            raise ValueError(f"priority must be in range({self.levels})")
+        with self._mutex:
+            if self._value >= n and not self._waiting:
+                self._value -= n
+                return True
+            if not blocking:
+                return False
+            ticket = Lock()
+            ticket.acquire()
+            waiter = [monotonic() - priority * self.aging, next(self._seq), n, ticket, True]
+            heappush(self._waiters, waiter)
+            self._waiting += 1
+            # a high enough priority may put it straight at the front
+            self._dispatch()
+        if timeout is None:
+            _acquire(ticket, lambda: self._withdraw(waiter))
+            return True
+        if ticket.acquire(timeout=timeout):
+            return True
+        if self._withdraw(waiter):
+            return False
+        return True
+
+    # takes waiter out of line; False if it was already handed its permits
+    def _withdraw(self, waiter: list) -> bool:
+        with self._mutex:
+            if not waiter[4]:
+                return False
+            # left in the heap and skipped once it reaches the top
+            waiter[4] = False
+            self._waiting -= 1
+            self._dispatch()
+            return True
+
+    def _dispatch(self):
+        while self._waiters:
+            waiter = self._waiters[0]
+            if waiter[4]:
+                if self._value < waiter[2]:
+                    return
+                self._value -= waiter[2]
+                waiter[4] = False
+                self._waiting -= 1
+                waiter[3].release()
+            heappop(self._waiters)
+
+    def release(self, n: int = 1):
+        with self._mutex:
+            self._value += n
+            self._dispatch()
+
+    __enter__ = acquire
+
+    def __exit__(self, type, val, traceback):
+        self.release()
+
+_select_turn = count()
+
+"""
+Blocks until any of sems can be acquired, acquires it and returns its
+index, or returns None after timeout seconds. Instead of spinning on
+non-blocking acquires, the caller sleeps until one of the semaphores is
+released. order picks among several free semaphores: "random", "first"
+(lowest index), or "fair" (round robin between calls). sems must be
+conc.Semaphores.
+"""
+def select_acquire(sems: list, timeout: float = None, order: str = "random", rng=random) -> int | None:
+    if not all(isinstance(sem, Semaphore) for sem in sems):
+        raise TypeError("select_acquire needs conc.Semaphore instances")
+    if order == "random":
+        indices = rng.sample(range(len(sems)), len(sems))
+    elif order == "fair":
+        start = next(_select_turn) % len(sems)
+        indices = [*range(start, len(sems)), *range(start)]
+    elif order == "first":
+        indices = range(len(sems))
+    else:
+        raise ValueError(f"unknown order {order!r}")
+
+    deadline = None if timeout is None else monotonic() + timeout
+    token = current_token()
+    selector = Event()
+    registered = False
+    waking = nullcontext() if token is None else token._waking(selector.set)
+    with waking:
+        try:
+            while True:
+                for i in indices:
+                    if sems[i].acquire(blocking=False):
+                        return i
+                if not registered:
+                    # register, then scan once more so a release that
+                    # lands between the scan and the wait isn't missed
+                    for sem in sems:
+                        sem._selectors.add(selector)
+                    registered = True
+                    continue
+                remaining = None if deadline is None else deadline - monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                if token is not None:
+                    token.check()
+                selector.wait(remaining)
+                selector.clear()
+        finally:
+            for sem in sems:
+                sem._selectors.discard(selector)
+
+# Semaphore.acquire that gives up if the calling thread's scope is cancelled.
+# FifoSemaphore and PrioritySemaphore already do that, and conc's other
+# semaphores wait on a Condition the token can wake. A single-use ticket
+# lock is woken by withdrawing it (see CancelToken._wait_ticket); anything
+# else is polled.
+def _acquire(sem, withdraw=None):
+    scope = getattr(_scope_local, "scope", None)
+    if scope is None or isinstance(sem, (FifoSemaphore, PrioritySemaphore)):
+        sem.acquire()
+    elif isinstance(sem, _Semaphore):
+        sem._acquire_cancellable(scope.token)
+    elif withdraw is not None:
+        scope.token._wait_ticket(sem, withdraw)
+    else:
+        scope.token.acquire(sem)
+
+# time.sleep that wakes up early with Cancelled if the scope is cancelled.
+def sleep(seconds: float):
+    scope = _current_scope()
+    if scope is None:
+        _sleep(seconds)
+    else:
+        scope.token.sleep(seconds)
+
+"""
+Opt-in contention instrumentation. After instrument(), newly built
+Lightswitches, Gates, Synchronizers and Cascades, and lock() keys,
+keep a Stats recording how often they're acquired, how long callers were
+blocked, how many were blocked at once, and how long they were held.
+Primitives built while instrumentation is off carry no Stats and only pay
+for an `is None` check.
+"""
+class Stats:
+    BUCKETS = 48
+
+    def __init__(self, name: str):
+        self.name = name
+        self.acquires = 0
+        self.contended = 0
+        self.waiting = 0
+        self.max_waiting = 0
+        self.total_wait_ns = 0
+        # log2 histograms: bucket i counts durations below 2**i ns
+        self.wait_hist = [0] * self.BUCKETS
+        self.hold_hist = [0] * self.BUCKETS
+        self._mutex = Lock()
+
+    # acquires sem, timing how long it blocked; withdraw as for _acquire
+    def acquire(self, sem, withdraw=None):
+        if sem.acquire(blocking=False):
+            with self._mutex:
+                self.acquires += 1
+                self.wait_hist[0] += 1
+            return
+        with self._mutex:
+            self.waiting += 1
+            self.max_waiting = max(self.max_waiting, self.waiting)
+        start = perf_counter_ns()
+        try:
+            _acquire(sem, withdraw)
+        finally:
+            waited = perf_counter_ns() - start
+            with self._mutex:
+                self.waiting -= 1
+        self.waited(waited)
+
+    # records an acquire that blocked for waited ns (0 if it didn't block)
+    def waited(self, waited: int):
+        with self._mutex:
+            self.acquires += 1
+            if waited:
+                self.contended += 1
+                self.total_wait_ns += waited
+            self.wait_hist[min(waited.bit_length(), self.BUCKETS - 1)] += 1
+
+    def held(self, since_ns: int):
+        held = perf_counter_ns() - since_ns
+        with self._mutex:
+            self.hold_hist[min(held.bit_length(), self.BUCKETS - 1)] += 1
+
+    @staticmethod
+    def _percentile(hist: list[int], p: float) -> int:
+        total = sum(hist)
+        if total == 0:
+            return 0
+        seen = 0
+        for i, n in enumerate(hist):
+            seen += n
+            if seen >= p * total:
+                return 0 if i == 0 else 1 << i
+        return 1 << (len(hist) - 1)
+
+    def snapshot(self) -> dict:
+        with self._mutex:
+            return {
+                "name": self.name,
+                "acquires": self.acquires,
+                "contended": self.contended,
+                "max_waiting": self.max_waiting,
+                "total_wait_ns": self.total_wait_ns,
+                "wait_p50_ns": self._percentile(self.wait_hist, 0.5),
+                "wait_p99_ns": self._percentile(self.wait_hist, 0.99),
+                "hold_p50_ns": self._percentile(self.hold_hist, 0.5),
+                "hold_p99_ns": self._percentile(self.hold_hist, 0.99),
+            }
+
+_instrumented = False
+_all_stats = []
+_all_stats_mutex = Lock()
+
+def instrument(enabled: bool = True):
+    global _instrumented
+    _instrumented = enabled
+
+# Stats for a new primitive, or None when instrumentation is off.
+def track(kind: str, name: str = None, owner=None) -> Stats | None:
+    if not _instrumented:
+        return None
+    if name is None:
+        name = f"{kind}@{id(owner):x}"
+    stats = Stats(name)
+    with _all_stats_mutex:
+        _all_stats.append(stats)
+    return stats
+
+def stats_snapshot() -> list[dict]:
+    with _all_stats_mutex:
+        stats = list(_all_stats)
+    return [s.snapshot() for s in stats]
+
+def reset_stats():
+    with _all_stats_mutex:
+        _all_stats.clear()
+    _registry.reset_stats()
+
+# prints the instrumented primitives, most time spent blocked first
+def report_stats(top: int = 20, file=None):
+    rows = sorted(stats_snapshot(), key=lambda s: s["total_wait_ns"], reverse=True)[:top]
+    cols = ("acquires", "contended", "max_waiting", "wait_p50_ns", "wait_p99_ns", "hold_p50_ns", "hold_p99_ns")
+    width = max([len(r["name"]) for r in rows] + [4])
+    print(f"{'name':<{width}}" + "".join(f"{c:>14}" for c in cols), file=file)
+    for r in rows:
+        print(f"{r['name']:<{width}}" + "".join(f"{r[c]:>14,}" for c in cols), file=file)
+
+
 """
 Lightswitch class from classical problems chapter
 """
 class Lightswitch :
-    def __init__ (self ):
+    def __init__ (self, name: str = None):
         self.counter = 0
-        self.mutex = Semaphore(1)
+        self.mutex = _Semaphore(1)
+        self._stats = track("Lightswitch", name, self)
+        self._since = 0
 
     def lock (self, semaphore):
-        self.mutex.acquire()
+        stats = self._stats
+        # only the room is timed; mutex is held briefly and would skew it
+        _acquire(self.mutex)
         self.counter += 1
         if self.counter == 1:
-            semaphore.acquire()
+            try:
+                if stats is None:
+                    _acquire(semaphore)
+                else:
+                    stats.acquire(semaphore)
+                    self._since = perf_counter_ns()
+            except Cancelled:
+                self.counter -= 1
+                self.mutex.release()
+                raise
         self.mutex.release()
 
     def unlock (self, semaphore):
         self.mutex.acquire()
         self.counter -= 1
         if self.counter == 0:
+            if self._stats is not None:
+                self._stats.held(self._since)
             semaphore.release()
         self.mutex.release()
 
 """
 Similar to the Lightswitch class from the classical problems chapter,
 but makes explicit the relationship between gatekeeper and gate visitors.
+Any number of visitors can be inside at once. close() shuts the gate to
+new visitors and blocks until everyone already inside has exited: the
+last one out wakes the gatekeeper with a single notify, and open() lets
+the visitors held up outside in with one broadcast. With a timeout, close
+gives up and reopens if the gate hasn't drained in time; try_close() only
+closes a gate that is already empty. drain_stats() reports how long
+closes waited for the gate to empty.
 """
 class Gate:
-    def __init__(self):
-        self._switch = Lightswitch()
+    def __init__(self, name: str = None):
         self._count = 0
-        self._mutex = Semaphore(1)
-        self._control = Semaphore(1)
+        self._closed = False
+        self._mutex = Lock()
+        self._drained = Condition(self._mutex)
+        self._opened = Condition(self._mutex)
+        # held by the gatekeeper from close() until open()
+        self._gatekeeper = _Semaphore(1)
+        self._closed_at = 0
+        self._drains = 0
+        self._timeouts = 0
+        self._total_drain_ns = 0
+        self._max_drain_ns = 0
+        self._stats = track("Gate", name, self)
 
     def enter(self):
-        self._mutex.acquire()
-        if self._count == 0:
-            self._control.acquire()
-        self._count += 1
-        self._mutex.release()
+        with self._mutex:
+            if not self._closed:
+                self._count += 1
+                if self._stats is not None:
+                    self._stats.waited(0)
+                return
+            start = perf_counter_ns()
+            token = current_token()
+            if token is None:
+                while self._closed:
+                    self._opened.wait()
+            else:
+                token.wait_for(self._opened, lambda: not self._closed)
+            self._count += 1
+        if self._stats is not None:
+            self._stats.waited(perf_counter_ns() - start)
 
     def exit(self):
-        self._mutex.acquire()
-        self._count -= 1
-        if self._count < 0:
-            raise RuntimeError("exit called more times than allowed")
-        if self._count == 0:
-            self._control.release()
-        self._mutex.release()
-    
+        with self._mutex:
+            if self._count == 0:
+                raise RuntimeError("exit called more times than allowed")
+            self._count -= 1
+            if self._count == 0 and self._closed:
+                self._drained.notify()
+
     """
-    Prevents entry until open()'d, and blocks the calling thread
-    until all entered threads have exited.
+    Prevents entry until open()'d, and blocks the calling thread until
+    all entered threads have exited. Returns False, with the gate open
+    again, if that takes longer than timeout seconds.
     """
-    def close(self):
-        self._mutex.acquire()
+    def close(self, timeout: float = None) -> bool:
+        deadline = None if timeout is None else monotonic() + timeout
+        if timeout is None:
+            _acquire(self._gatekeeper)
+        elif not self._gatekeeper.acquire(timeout=timeout):
+            return False
+        start = perf_counter_ns()
+        drained = False
+        with self._mutex:
+            self._closed = True
+            try:
+                token = current_token()
+                if token is not None and deadline is None:
+                    token.wait_for(self._drained, lambda: self._count == 0)
+                    drained = True
+                else:
+                    remaining = None if deadline is None else deadline - monotonic()
+                    drained = self._drained.wait_for(lambda: self._count == 0, remaining)
+            finally:
+                if drained:
+                    self._closed_at = perf_counter_ns()
+                    self._record_drain(self._closed_at - start)
+                else:
+                    self._timeouts += 1
+                    self._closed = False
+                    self._opened.notify_all()
+                    self._gatekeeper.release()
+        return drained
+
+    # closes the gate only if nobody is inside or closing it already
+    def try_close(self) -> bool:
+        if not self._gatekeeper.acquire(blocking=False):
+            return False
+        with self._mutex:
+            if self._count == 0:
+                self._closed = True
+                self._closed_at = perf_counter_ns()
+                self._record_drain(0)
+                return True
+        self._gatekeeper.release()
+        return False
 
     def open(self):
-        self._mutex.release()
+        with self._mutex:
+            if not self._closed:
+                raise RuntimeError("open called on a gate that isn't closed")
+            self._closed = False
+            self._opened.notify_all()
+        if self._stats is not None:
+            self._stats.held(self._closed_at)
+        self._gatekeeper.release()
+
+    # _mutex must be held
+    def _record_drain(self, drain_ns: int):
+        self._drains += 1
+        self._total_drain_ns += drain_ns
+        self._max_drain_ns = max(self._max_drain_ns, drain_ns)
+
+    def drain_stats(self) -> dict:
+        with self._mutex:
+            return {
+                "drains": self._drains,
+                "timeouts": self._timeouts,
+                "mean_drain_ns": self._total_drain_ns // self._drains if self._drains else 0,
+                "max_drain_ns": self._max_drain_ns,
+            }
+
+
+"""
+Singly linked list for the search-insert-delete problem. Searchers never
+lock: they walk the next pointers, which only ever change by a single
+assignment and are left intact on deleted nodes, so a search racing a
+delete either skips the deleted node or has already moved past it.
+Inserters only exclude each other, at the tail. Deleters find their node
+the same way, then lock it and its predecessor hand over hand and check
+the link is still there, so they only hold the two nodes on either side
+of the link they cut and deletes in different parts of the list overlap.
+"""
+class _Node:
+    __slots__ = ("value", "next", "pred", "lock", "deleted")
+
+    def __init__(self, value):
+        self.value = value
+        self.next = None
+        # the node before this one when it was deleted, for an inserter
+        # that finds the tail it was about to append to cut off
+        self.pred = None
+        self.lock = Lock()
+        self.deleted = False
+
+class SIDList:
+    def __init__(self, items=()):
+        self._head = _Node(None)
+        self._tail = self._head
+        self._tail_lock = Lock()
+        for item in items:
+            node = _Node(item)
+            self._tail.next = node
+            self._tail = node
+
+    def __iter__(self):
+        node = self._head.next
+        while node is not None:
+            if not node.deleted:
+                yield node.value
+            node = node.next
 
+    def search(self, value) -> bool:
+        node = self._head.next
+        while node is not None:
+            if node.value == value and not node.deleted:
+                return True
+            node = node.next
+        return False
+
+    __contains__ = search
+
+    def insert(self, value):
+        node = _Node(value)
+        with self._tail_lock:
+            tail = self._tail
+            while True:
+                with tail.lock:
+                    if not tail.deleted:
+                        tail.next = node
+                        break
+                tail = tail.pred
+            self._tail = node
+
+    # removes the first node holding value; False if there is none
+    def delete(self, value) -> bool:
+        while True:
+            # find the node without locking, then lock it and its
+            # predecessor and check nothing changed in between
+            prev, node = self._head, self._head.next
+            while node is not None and (node.value != value or node.deleted):
+                prev, node = node, node.next
+            if node is None:
+                return False
+            with prev.lock, node.lock:
+                if prev.deleted or node.deleted or prev.next is not node:
+                    continue
+                node.deleted = True
+                node.pred = prev
+                prev.next = node.next
+                return True
+
+"""
+Readers-writer lock with the policies from the classical problems chapter:
+- "readers": readers share the room as long as any reader is inside,
+  writers can starve.
+- "writers": once a writer is waiting, new readers queue behind it.
+- "fair": phase-fair. Reader and writer phases alternate: a reader that
+  arrives while a writer is inside or waiting waits for that writer to
+  finish, then enters together with every other reader queued behind
+  it, before the next writer gets in. So a reader waits for at most one
+  writer and a writer for at most one batch of readers (plus the writers
+  ahead of it, which are not served in arrival order).
+"readers" and "writers" are built from Lightswitches; "fair" keeps its
+counts under a Condition. Waits give up with Cancelled when the caller's
+Scope is cancelled.
+"""
+class RWLock:
+    POLICIES = ("readers", "writers", "fair")
+
+    def __init__(self, policy: str = "fair"):
+        if policy not in self.POLICIES:
+            raise ValueError(f"unknown policy {policy!r}, expected one of {self.POLICIES}")
+        self.policy = policy
+        self._read_switch = Lightswitch()
+        self._write_switch = Lightswitch()
+        self._room_empty = _Semaphore(1)
+        self._turnstile = _Semaphore(1)
+        self._no_writers = _Semaphore(1)
+        # "fair" state
+        self._cond = Condition(Lock())
+        self._readers = 0           # readers inside
+        self._writer = False        # a writer inside
+        self._writers_waiting = 0
+        self._blocked = 0           # readers waiting for the current writer phase to end
+        self._admitted = 0          # readers let in at the last phase change, not yet inside
+        self._phase = 0             # bumped at the end of every writer phase
+
+    @contextmanager
+    def read(self) -> Generator[None, None, None]:
+        if self.policy == "fair":
+            self._fair_read_enter()
+            try:
+                yield
+            finally:
+                self._fair_read_exit()
+            return
+        if self.policy == "writers":
+            _acquire(self._turnstile)
+            try:
+                self._read_switch.lock(self._no_writers)
+            finally:
+                self._turnstile.release()
+            room = self._no_writers
+        else:
+            self._read_switch.lock(self._room_empty)
+            room = self._room_empty
+        try:
+            yield
+        finally:
+            self._read_switch.unlock(room)
+
+    @contextmanager
+    def write(self) -> Generator[None, None, None]:
+        if self.policy == "fair":
+            self._fair_write_enter()
+            try:
+                yield
+            finally:
+                self._fair_write_exit()
+            return
+        if self.policy == "writers":
+            self._write_switch.lock(self._turnstile)
+            try:
+                _acquire(self._no_writers)
+            except Cancelled:
+                self._write_switch.unlock(self._turnstile)
+                raise
+            try:
+                yield
+            finally:
+                self._no_writers.release()
+                self._write_switch.unlock(self._turnstile)
+            return
+        _acquire(self._room_empty)
+        try:
+            yield
+        finally:
+            self._room_empty.release()
+
+    def _wait(self, predicate):
+        token = current_token()
+        if token is None:
+            while not predicate():
+                self._cond.wait()
+        else:
+            token.wait_for(self._cond, predicate)
+
+    def _fair_read_enter(self):
+        with self._cond:
+            if self._writer or self._writers_waiting:
+                phase = self._phase
+                self._blocked += 1
+                try:
+                    self._wait(lambda: self._phase != phase)
+                except Cancelled:
+                    if self._phase == phase:
+                        self._blocked -= 1
+                    else:
+                        self._admitted -= 1
+                        self._cond.notify_all()
+                    raise
+                self._admitted -= 1
+            self._readers += 1
+
+    def _fair_read_exit(self):
+        with self._cond:
+            self._readers -= 1
+            if self._readers == 0 and self._writers_waiting:
+                self._cond.notify_all()
+
+    def _fair_write_enter(self):
+        with self._cond:
+            self._writers_waiting += 1
+            try:
+                self._wait(lambda: not self._writer and self._readers == 0 and self._admitted == 0)
+            except Cancelled:
+                self._writers_waiting -= 1
+                # readers queued behind this writer alone would wait forever
+                if not self._writers_waiting and not self._writer:
+                    self._end_write_phase()
+                raise
+            self._writers_waiting -= 1
+            self._writer = True
+
+    def _fair_write_exit(self):
+        with self._cond:
+            self._writer = False
+            self._end_write_phase()
+
+    # lets in the readers that queued up during the writer phase
+    def _end_write_phase(self):
+        self._admitted += self._blocked
+        self._blocked = 0
+        self._phase += 1
+        self._cond.notify_all()
+
+
+"""
+Sequence lock over a small list, for state that is read far more often
+than it's written. Writers take turns on a mutex and bump a sequence
+number before and after changing the list in place, so it's odd while a
+write is in progress. Readers take no lock: read() copies the list and
+retries if the sequence number moved during the copy, so readers never
+block writers or each other. A reader that arrives mid-write waits for
+the write to finish.
+
+    occupancy = SeqLock([0] * n_rooms)
+    with occupancy.write() as rooms:
+        rooms[i] += 1
+    print(occupancy.read())
+"""
+class SeqLock:
+    def __init__(self, values):
+        self._values = list(values)
+        self._seq = 0
+        self._writer = Lock()
+
+    @property
+    def version(self) -> int:
+        return self._seq
+
+    @contextmanager
+    def write(self) -> Generator[list, None, None]:
+        with self._writer:
+            self._seq += 1
+            try:
+                yield self._values
+            finally:
+                self._seq += 1
+
+    # a consistent copy of the list and the version it was taken at
+    def snapshot(self) -> tuple[int, list]:
+        while True:
+            seq = self._seq
+            if seq & 1:
+                # wait for the writer to finish rather than spinning,
+                # which under the GIL mostly keeps it from running
+                with self._writer:
+                    pass
+                continue
+            values = self._values.copy()
+            if self._seq == seq:
+                return seq, values
+
+    def read(self) -> list:
+        return self.snapshot()[1]
+
+    # a single element needs no retry
+    def __getitem__(self, i: int):
+        return self._values[i]
+
+    def __len__(self):
+        return len(self._values)
+
+
+"""
+Read-copy-update cell holding one value that is never changed in place.
+Readers load it with get(), a single reference read that takes no lock
+and never waits. Writers build a new value and publish it with
+compare_and_set(expected, new), which only succeeds if the cell still
+holds expected (by identity), or update(fn), which reruns fn on the latest value until
+its publish wins; writers only wait for each other.
+
+on_retire(old), if given, is called once a replaced value is past its
+grace period: every read() section that could have seen it has ended.
+Values handed out by get() aren't tracked, so anything that must not
+outlive on_retire should be read inside `with cell.read() as value`.
+Retired values are checked after every publish, and synchronize() waits
+until all of them have been reclaimed.
+"""
+class RCUCell:
+    def __init__(self, value, on_retire=None):
+        self._value = value
+        self._epoch = 0
+        self._on_retire = on_retire
+        self._writer = Lock()
+        # (epoch it was replaced in, value) awaiting on_retire
+        self._retired = deque()
+        # (thread, [epoch of its read section in progress or None, depth])
+        self._slots = []
+        self._local = local()
+
+    def get(self):
+        return self._value
+
+    value = property(get)
+
+    def _slot(self) -> list:
+        slot = getattr(self._local, "slot", None)
+        if slot is None:
+            slot = self._local.slot = [None, 0]
+            with self._writer:
+                # threads that have exited are out of their read sections
+                # for good, so their slots can go
+                self._slots = [s for s in self._slots if s[0].is_alive()]
+                self._slots.append((current_thread(), slot))
+        return slot
+
+    @contextmanager
+    def read(self) -> Generator[object, None, None]:
+        slot = self._slot()
+        if slot[1] == 0:
+            # the epoch is recorded before the value is loaded, so a
+            # value replaced after that can't be reclaimed under us
+            slot[0] = self._epoch
+        slot[1] += 1
+        try:
+            yield self._value
+        finally:
+            slot[1] -= 1
+            if slot[1] == 0:
+                slot[0] = None
+
+    def compare_and_set(self, expected, new) -> bool:
+        with self._writer:
+            if self._value is not expected:
+                return False
+            self._publish(new)
+        self._reclaim()
+        return True
+
+    def set(self, new):
+        with self._writer:
+            self._publish(new)
+        self._reclaim()
+
+    def update(self, fn):
+        while True:
+            old = self._value
+            new = fn(old)
+            if self.compare_and_set(old, new):
+                return new
+
+    # _writer must be held
+    def _publish(self, new):
+        old = self._value
+        self._value = new
+        if self._on_retire is not None:
+            self._retired.append((self._epoch, old))
+        self._epoch += 1
+
+    # calls on_retire for every retired value no read section can still
+    # be using; True if none are left waiting
+    def _reclaim(self) -> bool:
+        if self._on_retire is None:
+            return True
+        done = []
+        with self._writer:
+            active = [slot[0] for _, slot in self._slots if slot[0] is not None]
+            oldest = min(active, default=self._epoch)
+            while self._retired and self._retired[0][0] < oldest:
+                done.append(self._retired.popleft()[1])
+            pending = bool(self._retired)
+        for old in done:
+            self._on_retire(old)
+        return not pending
+
+    def synchronize(self, poll: float = 1e-3):
+        while not self._reclaim():
+            sleep(poll)
+
+
+class QueueClosed(Exception):
+    pass
+
+"""
+FIFO queue holding at most maxsize items (unbounded if maxsize <= 0).
+put/get block by default; with block=False or a timeout they raise
+queue.Full/queue.Empty instead of waiting. put_many/get_many move
+several items per lock acquisition, which matters when items are cheap.
+
+close() is the poison pill: further puts raise QueueClosed, and once the
+remaining items are drained gets raise QueueClosed too. Iterating over
+the queue yields items until that point. close(error) marks the producer
+as failed: once drained, gets and iteration raise error instead.
+"""
+class BoundedQueue:
+    def __init__(self, maxsize: int = 0):
+        self.maxsize = maxsize
+        self._items = deque()
+        self._closed = False
+        self._error = None
+        self._mutex = Lock()
+        self._not_empty = Condition(self._mutex)
+        self._not_full = Condition(self._mutex)
+
+    def _space(self) -> int:
+        if self.maxsize <= 0:
+            return 1 << 62
+        return self.maxsize - len(self._items)
+
+    def _wait(self, cond: Condition, ready, block: bool, timeout, error):
+        if not block:
+            timeout = 0
+        token = current_token()
+        if token is not None and timeout is None:
+            token.wait_for(cond, ready)
+        elif not cond.wait_for(ready, timeout):
+            raise error
+
+    def put(self, item, block: bool = True, timeout: float = None):
+        self.put_many((item,), block, timeout)
+
+    # items are added as space frees up, so if it raises Full or
+    # QueueClosed partway through, a prefix of items was enqueued.
+    def put_many(self, items, block: bool = True, timeout: float = None):
+        items = deque(items)
+        with self._mutex:
+            while items:
+                self._wait(self._not_full, lambda: self._closed or self._space() > 0, block, timeout, Full)
+                if self._closed:
+                    raise QueueClosed("put on closed queue")
+                for _ in range(min(self._space(), len(items))):
+                    self._items.append(items.popleft())
+                self._not_empty.notify(len(self._items))
+
+    def get(self, block: bool = True, timeout: float = None):
+        return self.get_many(1, block, timeout)[0]
+
+    # returns between 1 and k items, waiting only for the first.
+    def get_many(self, k: int, block: bool = True, timeout: float = None) -> list:
+        with self._mutex:
+            self._wait(self._not_empty, lambda: self._closed or self._items, block, timeout, Empty)
+            if not self._items:
+                if self._error is not None:
+                    raise self._error
+                raise QueueClosed("get on closed and drained queue")
+            got = [self._items.popleft() for _ in range(min(k, len(self._items)))]
+            self._not_full.notify(len(got))
+            return got
+
+    def close(self, error: BaseException = None):
+        with self._mutex:
+            self._closed = True
+            if self._error is None:
+                self._error = error
+            self._not_empty.notify_all()
+            self._not_full.notify_all()
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    def __len__(self):
+        return len(self._items)
+
+    def __iter__(self):
+        while True:
+            try:
+                yield self.get()
+            except QueueClosed:
+                return
+
+
+def _apply_batch(fn, batch: list) -> list:
+    return [fn(item) for item in batch]
+
+"""
+Consumer stage for CPU-bound work: drains source in batches of up to
+batch items and runs fn over them in a pool of worker processes, so the
+work isn't serialized on the GIL. Results are put on sink, if given, in
+the order items were taken, and sink is closed once source is closed
+and drained. If a batch raises, source is closed and sink is closed with
+the exception, so its consumers get it instead of blocking forever. fn
+and the items must be picklable, i.e. fn has to be a module-level
+function. Returns an unstarted thread that feeds the pool.
+"""
+def process_stage(source: BoundedQueue, fn, workers: int, batch: int = 16, sink: BoundedQueue = None):
+    def run():
+        in_flight = deque()
+
+        def settle(limit: int):
+            while len(in_flight) > limit:
+                results = in_flight.popleft().result()
+                if sink is not None:
+                    sink.put_many(results)
+
+        error = None
+        try:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                # keep every worker busy with one batch queued behind it
+                while True:
+                    try:
+                        items = source.get_many(batch)
+                    except QueueClosed:
+                        break
+                    in_flight.append(executor.submit(_apply_batch, fn, items))
+                    settle(2 * workers)
+                settle(0)
+        except BaseException as e:
+            error = e
+            # stop producers rather than leave them blocked on a full source
+            source.close()
+            for future in in_flight:
+                future.cancel()
+            raise
+        finally:
+            if sink is not None:
+                sink.close(error)
+    return CustomThread(target=run)
+
+
+"""
+Reusable barrier for n threads. wait() returns the caller's arrival
+index for the current phase (0 for the first, n-1 for the last). The
+last arriver runs action, if any, before anyone is let through, then
+bumps the generation and wakes every waiter with one broadcast.
+
+If action raises, the barrier breaks like threading.Barrier: the last
+arriver gets the exception, everyone waiting in that phase and every
+later wait() raises BrokenBarrierError, until reset().
+"""
+class Barrier:
+    def __init__(self, n: int, action=None):
+        if n < 1:
+            raise ValueError("barrier needs at least one party")
+        self.n = n
+        self._action = action
+        self._count = 0
+        self._generation = 0
+        self._broken = False
+        # generation whose waiters were released by a failed action
+        self._broken_generation = None
+        self._cond = Condition(Lock())
+
+    @property
+    def broken(self) -> bool:
+        return self._broken
+
+    def wait(self) -> int:
+        with self._cond:
+            if self._broken:
+                raise BrokenBarrierError()
+            index = self._count
+            self._count += 1
+            if self._count == self.n:
+                try:
+                    if self._action is not None:
+                        self._action()
+                except BaseException:
+                    self._broken = True
+                    self._broken_generation = self._generation
+                    raise
+                finally:
+                    self._count = 0
+                    self._generation += 1
+                    self._cond.notify_all()
+                return index
+            generation = self._generation
+            token = current_token()
+            if token is None:
+                while generation == self._generation:
+                    self._cond.wait()
+            else:
+                try:
+                    token.wait_for(self._cond, lambda: generation != self._generation)
+                except Cancelled:
+                    self._count -= 1
+                    raise
+            if self._broken_generation == generation:
+                raise BrokenBarrierError()
+            return index
+
+    # repairs a broken barrier; nobody may be waiting on it
+    def reset(self):
+        with self._cond:
+            self._broken = False
+            self._count = 0
+
+
+"""
+Groups arrivals into complete batches per recipe, e.g. {"H": 2, "O": 1}
+for water. arrive() blocks until the caller's batch is complete and
+returns the batch id and its members as (kind, member) pairs, in recipe
+order. Each kind queues arrivals under its own lock and only touches the
+shared assembler once per full group of that kind, so kinds don't all
+contend on one lock for every arrival. An arrival cancelled before its
+batch completes backs out, and the rest of its group rejoins the line.
+"""
+class _Arrival:
+    __slots__ = ("kind", "member", "ready", "batch")
+
+    def __init__(self, kind, member):
+        self.kind = kind
+        self.member = member
+        self.batch = None
+        self.ready = Lock()
+        self.ready.acquire()
+
+class BatchBarrier:
+    def __init__(self, recipe: dict[Hashable, int]):
+        if not recipe or any(n < 1 for n in recipe.values()):
+            raise ValueError("recipe needs at least one kind, each with a positive count")
+        self.recipe = dict(recipe)
+        self._kinds = {kind: (Lock(), deque()) for kind in recipe}
+        self._groups = {kind: deque() for kind in recipe}
+        self._short = len(recipe) # kinds with no complete group yet
+        self._assembler = Lock()
+        self._batches = count()
+
+    def arrive(self, kind: Hashable, member=None) -> tuple[int, list]:
+        arrival = _Arrival(kind, member)
+        mutex, waiting = self._kinds[kind]
+        with mutex:
+            waiting.append(arrival)
+            if len(waiting) == self.recipe[kind]:
+                group = list(waiting)
+                waiting.clear()
+                # posted before letting go of mutex, so a cancelled member
+                # finds its group either in waiting or in the assembler
+                self._post(kind, group)
+        # if its batch completes before it can back out, it takes part
+        _acquire(arrival.ready, lambda: self._withdraw(arrival))
+        return arrival.batch
+
+    # takes arrival out of its kind's line or its queued group; False if
+    # it's already part of a batch
+    def _withdraw(self, arrival: _Arrival) -> bool:
+        kind = arrival.kind
+        mutex, waiting = self._kinds[kind]
+        with mutex:
+            if arrival in waiting:
+                waiting.remove(arrival)
+                return True
+            with self._assembler:
+                groups = self._groups[kind]
+                group = next((g for g in groups if arrival in g), None)
+                if group is None:
+                    return False
+                groups.remove(group)
+                if not groups:
+                    self._short += 1
+            # the rest of the group goes back to the head of the line
+            group.remove(arrival)
+            waiting.extendleft(reversed(group))
+            n = self.recipe[kind]
+            if len(waiting) >= n:
+                self._post(kind, [waiting.popleft() for _ in range(n)])
+        return True
+
+    def _post(self, kind, group: list):
+        with self._assembler:
+            groups = self._groups[kind]
+            groups.append(group)
+            if len(groups) == 1:
+                self._short -= 1
+            if self._short > 0:
+                return
+            batch_groups = []
+            for gs in self._groups.values():
+                batch_groups.append(gs.popleft())
+                if not gs:
+                    self._short += 1
+            batch_id = next(self._batches)
+        members = [(a.kind, a.member) for g in batch_groups for a in g]
+        for g in batch_groups:
+            for arrival in g:
+                arrival.batch = (batch_id, members)
+                arrival.ready.release()
+
+
+"""
+Rendezvous between A and B callers: each syncA is paired with exactly
+one syncB and they swap values. Whoever arrives first parks on its own
+slot; the second arrival fills in the reply and wakes just that peer,
+so an exchange costs one mutex round-trip and one targeted wakeup.
+"""
+class _Slot:
+    __slots__ = ("send", "reply", "ready", "need")
+
+    # need is None for a single exchange, or how many values a gather waits for
+    def __init__(self, send, need: int = None):
+        self.send = send
+        self.need = need
+        self.reply = None if need is None else []
+        self.ready = Lock()
+        self.ready.acquire()
 
 class Synchronizer():
-    def __init__(self):
-        self.aPresent = False
-        self.bPresent = False
-        self.mutex = Semaphore(1)
-        self.mutA = Semaphore(0)
-        self.mutB = Semaphore(0)
-        self.mutASend = Semaphore(0)
-        self.mutBSend = Semaphore(0)
+    def __init__(self, name: str = None):
+        self.mutex = Lock()
         self.aq = deque()
         self.bq = deque()
-        self.sendA = None
-        self.sendB = None
+        self._stats = track("Synchronizer", name, self)
+
+    def _sync(self, send, mine: deque, theirs: deque):
+        with self.mutex:
+            if not theirs:
+                slot = _Slot(send)
+                mine.append(slot)
+                peer = None
+            else:
+                peer = theirs[0]
+                if peer.need is None:
+                    peer.reply = send
+                else:
+                    peer.reply.append(send)
+                if peer.need is None or len(peer.reply) == peer.need:
+                    theirs.popleft()
+                    peer.ready.release()
+        if peer is None:
+            return self._park(slot, mine)
+        # paired without blocking
+        if self._stats is not None:
+            self._stats.waited(0)
+        return peer.send
+
+    def _park(self, slot: _Slot, mine: deque):
+        # a peer pairing with us before we can back out wins over cancel
+        withdraw = lambda: self._withdraw(slot, mine)
+        if self._stats is None:
+            _acquire(slot.ready, withdraw)
+        else:
+            self._stats.acquire(slot.ready, withdraw)
+        return slot.reply
+
+    def _withdraw(self, slot: _Slot, mine: deque) -> bool:
+        with self.mutex:
+            if slot not in mine:
+                return False
+            mine.remove(slot)
+            return True
 
     def syncA(self, send=None):
-        self.mutB.release()
-        self.mutA.acquire()
-        self.mutex.acquire()
-        self.aq.append(send)
-        self.mutex.release()
-        self.mutBSend.release()
-        self.mutASend.acquire()
-        self.mutex.acquire()
-        v = self.bq.popleft()
-        self.mutex.release()
-        return v
+        return self._sync(send, self.aq, self.bq)
             
     def syncB(self, send=None):
-        self.mutA.release()
-        self.mutB.acquire()
-        self.mutex.acquire()
-        self.bq.append(send)
-        self.mutex.release()
-        self.mutASend.release()
-        self.mutBSend.acquire()
-        self.mutex.acquire()
-        v = self.aq.popleft()
-        self.mutex.release()
-        return v
+        return self._sync(send, self.bq, self.aq)
+
+    # k syncB's in one: pairs with k syncA callers, gives each of them
+    # send, and returns their values in order once the last has arrived.
+    def gather(self, k: int, send=None) -> list:
+        if k < 1:
+            return []
+        slot = _Slot(send, k)
+        with self.mutex:
+            while self.aq and not self.bq and len(slot.reply) < k:
+                peer = self.aq.popleft()
+                peer.reply = send
+                peer.ready.release()
+                slot.reply.append(peer.send)
+            complete = len(slot.reply) == k
+            if not complete:
+                self.bq.append(slot)
+        if not complete:
+            return self._park(slot, self.bq)
+        if self._stats is not None:
+            self._stats.waited(0)
+        return slot.reply
     
 
-_lockLookup = {}
+"""
+Keyed mutexes for lock(). Keys are hashed onto a fixed number of stripes,
+each with its own small mutex guarding a dict of the live entries for
+that stripe, so unrelated keys never contend on creation. Entries are
+reference counted by their holders and waiters and dropped as soon as
+the last one leaves, so the registry only holds keys currently in use.
+When instrumented, the first MAX_TRACKED_KEYS keys get a Stats each and
+any further keys share one, so short-lived keys can't pile up Stats.
+"""
+class LockRegistry:
+    MAX_TRACKED_KEYS = 256
+
+    def __init__(self, stripes: int = 64):
+        if stripes < 1:
+            raise ValueError("stripes must be positive")
+        self._stripes = [(threading.Semaphore(1), {}) for _ in range(stripes)]
+        self._stats = {}
+        self._other_stats = None
+        self._stats_mutex = threading.Semaphore(1)
+
+    def _stripe(self, key: Hashable):
+        return self._stripes[hash(key) % len(self._stripes)]
+
+    def _track(self, key: Hashable) -> Stats | None:
+        with self._stats_mutex:
+            stats = self._stats.get(key)
+            if stats is None:
+                if len(self._stats) < self.MAX_TRACKED_KEYS:
+                    stats = self._stats[key] = track("lock", f"lock({key!r})")
+                else:
+                    if self._other_stats is None:
+                        self._other_stats = track("lock", "lock(<other keys>)")
+                    stats = self._other_stats
+            return stats
+
+    def reset_stats(self):
+        with self._stats_mutex:
+            self._stats.clear()
+            self._other_stats = None
+
+    def acquire(self, key: Hashable):
+        mutex, entries = self._stripe(key)
+        mutex.acquire()
+        entry = entries.get(key)
+        if entry is None:
+            # [semaphore, holders and waiters, held since ns, Stats]
+            entry = entries[key] = [_Semaphore(1), 0, 0, None]
+        entry[1] += 1
+        if _instrumented and entry[3] is None:
+            entry[3] = self._track(key)
+        stats = entry[3]
+        mutex.release()
+        try:
+            if stats is None:
+                _acquire(entry[0])
+                return
+            stats.acquire(entry[0])
+        except Cancelled:
+            mutex.acquire()
+            entry[1] -= 1
+            if entry[1] == 0:
+                del entries[key]
+            mutex.release()
+            raise
+        entry[2] = perf_counter_ns()
+
+    def release(self, key: Hashable):
+        mutex, entries = self._stripe(key)
+        mutex.acquire()
+        entry = entries[key]
+        entry[1] -= 1
+        if entry[1] == 0:
+            del entries[key]
+        mutex.release()
+        try:
+            if entry[2]:
+                since, entry[2] = entry[2], 0
+                entry[3].held(since)
+        finally:
+            entry[0].release()
+
+    def __len__(self):
+        return sum(len(entries) for _, entries in self._stripes)
+
+_registry = LockRegistry()
 
 # Behaves like java's synchronized blocks, creating or
 # obtaining a mutex given a hashable object key.
 class lock:
-    def __init__(self, key: Hashable):
-        if key not in _lockLookup:
-            _lockLookup[key] = Semaphore(1)
-        self.sem = _lockLookup[key]
+    def __init__(self, key: Hashable, registry: LockRegistry = None):
+        self.key = key
+        self.registry = _registry if registry is None else registry
 
     def __enter__(self):
-        self.sem.acquire()
+        self.registry.acquire(self.key)
     
     def __exit__(self, type, val, traceback):
-        self.sem.release()
+        self.registry.release(self.key)
 
 def semaphores(*sizes):
     return (Semaphore(s) for s in sizes)
+
+# Iterations for an actor's main loop: n of them, or forever if n is None.
+# Inside a Scope, iteration also stops once the scope is cancelled.
+def rounds(n: int | None):
+    it = count() if n is None else range(n)
+    token = current_token()
+    if token is None:
+        return it
+    return takewhile(lambda _: not token.cancelled, it)
+
+
+"""
+Event tracing for the simulations, in place of printing from every actor.
+
+event() appends (timestamp_ns, thread, label, event) to a ring buffer
+owned by the calling thread, so recording never touches a shared lock or
+stdout. A daemon thread drains all buffers every interval seconds, merges
+them by timestamp and hands the batch to the sinks: stdout when echo is
+set, plus any files added with export_jsonl/export_binary. If a thread
+records more than capacity events between flushes its oldest are
+dropped. With enabled False, event() returns immediately.
+"""
+class Tracer:
+    def __init__(self, capacity: int = 65536, interval: float = 0.1, echo: bool = True, enabled: bool = True):
+        self.capacity = capacity
+        self.interval = interval
+        self.echo = echo
+        self.enabled = enabled
+        self._local = local()
+        # (thread, its buffer); dead threads' buffers are dropped once drained
+        self._buffers = []
+        self._sinks = []
+        self._mutex = Lock()
+        # one drain and emit at a time, so batches go out in order
+        self._flush_mutex = Lock()
+        self._flusher = None
+        atexit.register(self.flush)
+
+    def _buffer(self) -> deque:
+        buffer = self._local.buffer = deque(maxlen=self.capacity)
+        with self._mutex:
+            self._buffers.append((current_thread(), buffer))
+            if self._flusher is None:
+                self._flusher = Thread(target=self._flush_loop, name="trace-flush", daemon=True)
+                self._flusher.start()
+        return buffer
+
+    def event(self, label, event):
+        if not self.enabled:
+            return
+        try:
+            buffer = self._local.buffer
+        except AttributeError:
+            buffer = self._buffer()
+        buffer.append((time_ns(), current_thread().name, label, event))
+
+    # removes and returns everything recorded so far, oldest first
+    def drain(self) -> list[tuple]:
+        with self._flush_mutex:
+            return self._drain()
+
+    def _drain(self) -> list[tuple]:
+        with self._mutex:
+            buffers = list(self._buffers)
+        events = []
+        finished = []
+        for thread, buffer in buffers:
+            # checked first: a thread that was dead before draining
+            # can't have added anything since
+            dead = not thread.is_alive()
+            # a full buffer drops its oldest event on every append, so
+            # it can run out before len(buffer) pops
+            for _ in range(len(buffer)):
+                try:
+                    events.append(buffer.popleft())
+                except IndexError:
+                    break
+            if dead:
+                finished.append((thread, buffer))
+        if finished:
+            with self._mutex:
+                finished = {id(buffer) for _, buffer in finished}
+                self._buffers = [b for b in self._buffers if id(b[1]) not in finished]
+        events.sort(key=lambda e: e[0])
+        return events
+
+    def flush(self):
+        with self._flush_mutex:
+            events = self._drain()
+            if not events:
+                return
+            if self.echo:
+                sys.stdout.write("".join(f"{label}: {event}\n" for _, _, label, event in events))
+                sys.stdout.flush()
+            for sink in self._sinks:
+                sink(events)
+
+    def _flush_loop(self):
+        while True:
+            _sleep(self.interval)
+            try:
+                self.flush()
+            except Exception:
+                # keep tracing alive if a sink fails
+                traceback.print_exc()
+
+    def add_sink(self, sink):
+        self._sinks.append(sink)
+
+    def export_jsonl(self, path: str):
+        def sink(events):
+            with open(path, "a") as f:
+                f.writelines(json.dumps({"ts": ts, "thread": thread, "label": str(label), "event": str(event)}) + "\n"
+                             for ts, thread, label, event in events)
+        self.add_sink(sink)
+
+    # records are <q ts><H><H><H> lengths followed by the utf-8
+    # thread name, label and event.
+    def export_binary(self, path: str):
+        def sink(events):
+            with open(path, "ab") as f:
+                for ts, thread, label, event in events:
+                    fields = [str(x).encode() for x in (thread, label, event)]
+                    f.write(struct.pack("<qHHH", ts, *map(len, fields)) + b"".join(fields))
+        self.add_sink(sink)
+
+trace = Tracer()
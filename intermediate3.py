@@ -1,74 +1,67 @@
 import random
-from collections import deque
 from threading import Semaphore as Sem
 from time import sleep
 from functools import reduce
 
-from conc import thread, Synchronizer, lock, semaphores
+from conc import thread, Synchronizer, lock, semaphores, trace, FifoSemaphore, BatchBarrier
 
 """
 5.4 Hilzer's Barbershop
+
+Standing customers take the sofa in the order they arrived, and the
+customer who has been on the sofa longest gets the next haircut. Both
+queues are FifoSemaphores, so a barber's signal wakes exactly the
+customer whose turn it is.
 """
 
-def p5_4():
-    n_customers = 100
-    n_barbers = 3
-    sofa_size = 4
-    shop_size = 20
+def p5_4(n_customers=100, n_barbers=3, sofa_size=4, shop_size=20):
+    # customers no barber has claimed yet
     customers_left = n_customers
 
-    sofa = deque()
-
-    sofa_spots = Sem(sofa_size)
+    sofa_spots = FifoSemaphore(sofa_size)
     shop_spots = Sem(shop_size)
     
-    haircut_ready = Sem(0)
+    haircut_ready = FifoSemaphore(0)
     haircuts = Synchronizer()
 
     register = Synchronizer()
     paid = Sem(0)
 
-    @thread()
+    # customers beyond shop_size would only block on shop_spots anyway,
+    # so they can share shop_size workers instead of a thread each.
+    @thread(pool=shop_size)
     def customer(label: str):
-        def out(s): print(f"{label}: {s}")
+        def out(s): trace.event(label, s)
         
         shop_spots.acquire()
         out("enterShop")
 
         sofa_spots.acquire()
-        with lock("sofa"):
-            out("sitOnSofa")
-            sofa.append(label)
-        while True:
-            # spinlock to get the correct queue member
-            # barber signals when ready
-            haircut_ready.acquire()
-            with lock("sofa"):
-                if sofa[0] == label:
-                    sofa.popleft()
-                    break
-            haircut_ready.release()
-        
+        out("sitOnSofa")
+        # barber signals when ready
+        haircut_ready.acquire()
+
         barber = haircuts.syncA(label)
         sofa_spots.release()
         out(f"getHairCut by {barber}")
 
         registrar = register.syncA(label)
         out(f"pay {registrar}")
-        with lock("customers_left"):
-            nonlocal customers_left
-            customers_left -= 1
         paid.release()
         shop_spots.release()
         
     @thread()
     def barber(label: str):
-        def out(s): print(f"{label}: {s}")
+        def out(s): trace.event(label, s)
+        nonlocal customers_left
         while True:
+            # claim the next customer up front, so no barber is left
+            # waiting on a haircut that will never come
             with lock("customers_left"):
                 if customers_left < 1:
                     out("done")
                     return
+                customers_left -= 1
             haircut_ready.release()
             client = haircuts.syncB(label)
             out(f"cutHair for {client}")
@@ -79,52 +72,37 @@ def p5_4():
                 out(f"acceptPayment {payer}")
 
 
-    for i in range(n_customers):
-        customer(f"[cust {i}]").start()
-    
-    for i in range(n_barbers):
-        barber(f"[barb {i}]").start()
+    customers = [customer(f"[cust {i}]").start() for i in range(n_customers)]
+    barbers = [barber(f"[barb {i}]").start() for i in range(n_barbers)]
+    return customers + barbers
 
 """
 5.6 Building H20
 
 We want to synchronize molecules so that a specified number can pass through
-the barrier before the next batch goes through. Rather than maintaining a
-data structure to queue up the atoms, we only have semaphores for each
-kind of atom. Once the last atom is added, the molecule is completed and
-all semaphores are signalled for the next batch.
-
-This functionality is generalized to any recipe, not just h20.
+the barrier before the next batch goes through. This was first solved with
+a semaphore per kind of atom and a shared counter, and is now generalized to
+any recipe by conc.BatchBarrier: each atom learns which molecule it ended up
+in and who its partners are.
 """
-def p5_6():
+def p5_6(n_atoms=20):
     h20_recipe = {
         "hydrogen": 2,
         "oxygen": 1
     }
-
-    def make_queue(recipe: dict[str, int]):
-        return [0, {kind: Sem(recipe[kind]) for kind in recipe}]
+    bonds = BatchBarrier(h20_recipe)
 
     @thread()
-    def atom(label: str, kind: str, recipe: dict[str, int], queue: list[int, dict[str, Sem]]):
+    def atom(label: str, kind: str):
         sleep(random.random())
-        total = sum(recipe[k] for k in recipe)
-
-        queue[1][kind].acquire()
-        print(label, flush=True)
-        with lock("queue"):
-            queue[0] += 1
-            if queue[0] == total:
-                queue[0] = 0
-                print("----------------", flush=True)
-                for k in recipe:
-                    queue[1][k].release(recipe[k])
-
-    n_atoms = 20
-    q = make_queue(h20_recipe)
-    for kind in h20_recipe:
-        for i in range(h20_recipe[kind] * n_atoms):
-            atom(f"[{kind} {i}]", kind, h20_recipe, q).start()
+        molecule, members = bonds.arrive(kind, label)
+        trace.event(label, f"joined molecule {molecule}")
+        if members[0][1] == label:
+            trace.event(f"[molecule {molecule}]", " ".join(m for _, m in members))
+
+    return [atom(f"[{kind} {i}]", kind).start()
+            for kind in h20_recipe
+            for i in range(h20_recipe[kind] * n_atoms)]
 
 """
 5.8 Rollercoaster
@@ -133,14 +111,13 @@ Super basic, but gave me the idea of a function `semaphores` for
 mass instantiation of sems.
 """
 
-def p5_8():
-    C = 5
-    n = 100
+def p5_8(C=5, n=100):
 
-    loaded, boarded, unboard = semaphores(0, 0, 0)
+    loaded, unboard = semaphores(0, 0)
+    boarded = FifoSemaphore(0)
 
-    def out(label, msg, *a, **kw):
-        print(f"{label}: {msg}", *a, **kw)
+    def out(label, msg):
+        trace.event(label, msg)
 
 
     @thread()
@@ -163,8 +140,7 @@ def p5_8():
             out(lbl, "load")
             loaded.release(C)
 
-            for _ in range(C):
-                boarded.acquire()
+            boarded.acquire(n=C)
             
             out(lbl, "run")
 
@@ -173,7 +149,6 @@ def p5_8():
 
             served += C
     
-    car("[car]").start()
-    for i in range(n):
-        passenger(f"[passenger {i}]").start()
+    car_thread = car("[car]").start()
+    return [car_thread] + [passenger(f"[passenger {i}]").start() for i in range(n)]
 